@@ -0,0 +1,158 @@
+import os
+import gzip
+import json
+import typing as t
+
+from types import SimpleNamespace
+from datetime import datetime
+
+import discord
+
+
+# bumped on incompatible changes of the snapshot layout
+ARCHIVE_VERSION = 1
+
+
+class ArchivedAuthor:
+    """
+    message author as exported, role names are the ones author had at export time
+    """
+    __slots__ = ('id', 'name', 'display_name', 'bot', 'role_names')
+
+    def __init__(self, id: int, name: str, display_name: str, bot: bool, role_names: t.List[str]) -> None:
+        self.id = id
+        self.name = name
+        self.display_name = display_name
+        self.bot = bot
+        self.role_names = role_names
+
+
+class ArchivedThread(SimpleNamespace):
+    """
+    thread as exported, process_message() tells thread from channel by `parent`
+    """
+
+
+def snapshot(message: discord.Message) -> t.Dict[str, t.Any]:
+    """
+    everything process_message() reads from discord.Message, so exported history can be reprocessed
+    without Discord API; clean_content and role names are resolved at export time
+    """
+    channel, thread = message.channel, None
+    if hasattr(channel, 'parent'):  # message is in thread
+        channel, thread = channel.parent, channel
+    author = message.author
+    category = channel.category
+    return {
+        'v': ARCHIVE_VERSION,
+        'id': message.id,
+        'guild': {'id': message.guild.id, 'name': message.guild.name},
+        'channel': {
+            'id': channel.id,
+            'name': channel.name,
+            'category_id': channel.category_id,
+            'category': category.name if category else None
+        },
+        'thread': {'id': thread.id, 'name': thread.name} if thread else None,
+        'author': {
+            'id': author.id,
+            'name': author.name,
+            'display_name': author.display_name,
+            'bot': author.bot,
+            'roles': [_.name for _ in author.roles] if isinstance(author, discord.Member) else []
+        },
+        'content': message.content,
+        'clean_content': message.clean_content,
+        'created_at': message.created_at.isoformat(),
+        'edited_at': message.edited_at.isoformat() if message.edited_at else None,
+        'type': message.type.name,
+        'reference_id': message.reference.message_id if message.reference else None,
+        'mentions': message.raw_mentions,
+        'reactions': [[str(_.emoji), isinstance(_.emoji, str), _.count] for _ in message.reactions],
+        'attachments': [_.url for _ in message.attachments],
+    }
+
+
+def restore(data: t.Dict[str, t.Any]) -> SimpleNamespace:
+    """
+    message-like object from snapshot, accepted by process_message()
+    """
+    if data.get('v') != ARCHIVE_VERSION:
+        raise ValueError(f'Unsupported archive version {data.get("v")} of message {data.get("id")}')
+    guild = SimpleNamespace(**data['guild'])
+    _channel = data['channel']
+    category = SimpleNamespace(id=_channel['category_id'], name=_channel['category']) if _channel['category'] else None
+    channel = SimpleNamespace(id=_channel['id'], name=_channel['name'], category_id=_channel['category_id'],
+                              category=category, guild=guild)
+    if data['thread']:
+        channel = ArchivedThread(**data['thread'], parent=channel, parent_id=channel.id, guild=guild)
+    author = data['author']
+    return SimpleNamespace(
+        id=data['id'],
+        guild=guild,
+        channel=channel,
+        author=ArchivedAuthor(author['id'], author['name'], author['display_name'], author['bot'], author['roles']),
+        content=data['content'],
+        clean_content=data['clean_content'],
+        created_at=datetime.fromisoformat(data['created_at']),
+        edited_at=datetime.fromisoformat(data['edited_at']) if data['edited_at'] else None,
+        type=SimpleNamespace(name=data['type']),
+        reference=SimpleNamespace(message_id=data['reference_id']) if data['reference_id'] else None,
+        raw_mentions=data['mentions'],
+        # custom emojis are kept as PartialEmoji, the same as discord.py gives them
+        reactions=[SimpleNamespace(emoji=_emoji if is_unicode else discord.PartialEmoji.from_str(_emoji), count=count)
+                   for _emoji, is_unicode, count in data['reactions']],
+        attachments=[SimpleNamespace(url=_) for _ in data['attachments']],
+    )
+
+
+class ArchiveWriter:
+    """
+    appends message snapshots to gzipped JSONL files partitioned by channel and day:
+    <path>/<channel_id>/<YYYY-MM-DD>/<channel_or_thread_id>.jsonl.gz;
+    every channel/thread has a file of its own, so they are exported concurrently,
+    history is collected oldest first, so only one file per channel/thread is open at a time
+    """
+    def __init__(self, path: str) -> None:
+        self._path = path
+        self._files: t.Dict[int, t.Tuple[str, t.IO[bytes]]] = dict()
+        self.written = 0
+
+    def write(self, message: discord.Message) -> None:
+        data = snapshot(message)
+        source_id = data['thread']['id'] if data['thread'] else data['channel']['id']
+        day = data['created_at'][:10]
+        current = self._files.get(source_id)
+        if current is None or current[0] != day:
+            if current is not None:
+                current[1].close()
+            directory = os.path.join(self._path, str(data['channel']['id']), day)
+            os.makedirs(directory, exist_ok=True)
+            # appending to existing file adds gzip member, re-exported days are deduplicated by ES doc id on load
+            current = self._files[source_id] = (day, gzip.open(os.path.join(directory, f'{source_id}.jsonl.gz'), 'ab'))
+        current[1].write(json.dumps(data, ensure_ascii=False, separators=(',', ':')).encode() + b'\n')
+        self.written += 1
+
+    def close_source(self, source_id: int) -> None:
+        current = self._files.pop(source_id, None)
+        if current is not None:
+            current[1].close()
+
+    def close(self) -> None:
+        for source_id in list(self._files):
+            self.close_source(source_id)
+
+
+def archive_files(path: str) -> t.List[str]:
+    """
+    all partition files under archive path, the largest first
+    """
+    files = [os.path.join(root, _) for root, _, names in os.walk(path) for _ in names if _.endswith('.jsonl.gz')]
+    return sorted(files, key=os.path.getsize, reverse=True)
+
+
+def read_archive(path: str) -> t.Iterator[SimpleNamespace]:
+    with gzip.open(path, 'rb') as f:
+        for line in f:
+            if line.strip():
+                yield restore(json.loads(line))
@@ -0,0 +1,90 @@
+"""
+micro-benchmark of ES bulk body building and memory held per in-flight message,
+compares dict docs serialized the way async_bulk did it with MessageRecord docs and ES sink bytes bodies
+
+    python -m benchmarks.bulk_body_bench --messages 20000
+"""
+import time
+import asyncio
+import argparse
+import tracemalloc
+import typing as t
+
+from elasticsearch.helpers import expand_action
+from elasticsearch.serializer import JSONSerializer
+
+from benchmarks.synthetic import make_corpus
+from benchmarks.process_message_bench import legacy_process_message
+from benchmarks.fakes import FakeElasticsearch
+from record import orjson
+from utils import process_message
+from sinks import ElasticsearchSink
+
+
+def legacy_body(actions: t.List[dict], serializer: JSONSerializer) -> bytes:
+    """
+    async_bulk chunking and client.bulk body as they were before bytes bodies, kept here as the baseline
+    """
+    bulk_actions, size = list(), 0
+    for action in actions:
+        header, data = expand_action(action)
+        header = serializer.dumps(header)
+        size += len(header.encode("utf-8")) + 1  # async_bulk measures every line to split chunks
+        bulk_actions.append(header)
+        data = serializer.dumps(data)
+        size += len(data.encode("utf-8")) + 1
+        bulk_actions.append(data)
+    return ("\n".join(bulk_actions) + "\n").encode("utf-8")  # transport encodes str body
+
+
+def measure(build: t.Callable[[], bytes], repeat: int) -> t.Tuple[float, int]:
+    best, body = float('inf'), b''
+    for _ in range(repeat):
+        started_at = time.perf_counter()
+        body = build()
+        best = min(best, time.perf_counter() - started_at)
+    return best, len(body)
+
+
+async def retained_bytes(process, corpus) -> int:
+    tracemalloc.start()
+    docs = [(await process(_))[1] for _ in corpus]
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del docs
+    return size
+
+
+async def run(args: argparse.Namespace) -> None:
+    corpus = make_corpus(args.messages, args.channels)
+    sink = ElasticsearchSink(FakeElasticsearch())
+    legacy_docs = [await legacy_process_message(_) for _ in corpus]
+    docs = [await process_message(_) for _ in corpus]
+
+    def _actions(_docs):
+        return [{'_index': 'discord', '_op_type': 'index', '_id': _id, '_source': _doc} for _id, _doc in _docs]
+
+    legacy_actions, actions = _actions(legacy_docs), _actions(docs)
+    before, before_size = measure(lambda: legacy_body(legacy_actions, JSONSerializer()), args.repeat)
+    after, after_size = measure(lambda: sink._body(actions), args.repeat)
+    legacy_memory = await retained_bytes(legacy_process_message, corpus)
+    memory = await retained_bytes(process_message, corpus)
+
+    print(f'serializer: {"orjson" if orjson is not None else "stdlib json"}')
+    print(f'{"implementation":<16}{"docs/sec":>12}{"body MiB":>12}{"bytes/doc held":>18}')
+    print(f'{"before":<16}{len(corpus) / before:>12.0f}{before_size / 2 ** 20:>12.1f}'
+          f'{legacy_memory / len(corpus):>18.0f}')
+    print(f'{"after":<16}{len(corpus) / after:>12.0f}{after_size / 2 ** 20:>12.1f}{memory / len(corpus):>18.0f}')
+    print(f'speedup x{before / after:.2f}, memory x{legacy_memory / memory:.2f} less')
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--messages', type=int, default=20000)
+    parser.add_argument('--channels', type=int, default=50)
+    parser.add_argument('--repeat', type=int, default=3)
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == '__main__':
+    main()
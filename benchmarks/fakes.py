@@ -0,0 +1,156 @@
+"""
+in-process stand-ins for discord.Client, AsyncElasticsearch and Kafka producer used by the replay harness
+"""
+import asyncio
+import typing as t
+
+from types import SimpleNamespace
+from collections import Counter
+from elasticsearch.serializer import JSONSerializer
+
+from benchmarks.synthetic import SyntheticGuild  # sets up env of the scraper modules
+from writer import FIELDS_REPLACE_SCRIPT
+from utils import REACTION_UPDATE_SCRIPT, REACTION_CLEAR_SCRIPT
+
+
+class FakeClient:
+    """
+    stand-in for discord.Client: channels are looked up in synthetic guild,
+    event handlers registered with @client.event are invoked by dispatch()
+    """
+    def __init__(self, guild: SyntheticGuild) -> None:
+        self.guild = guild
+        self.guilds = [guild]
+        self.user = SimpleNamespace(id=0, name='scraper')
+        self.handlers: t.Dict[str, t.Callable] = dict()
+
+    def event(self, coro):
+        self.handlers[coro.__name__] = coro
+        return coro
+
+    async def dispatch(self, event: str, *args) -> None:
+        handler = self.handlers.get(f'on_{event}')
+        if handler is not None:
+            await handler(*args)
+
+    def get_channel(self, channel_id: int):
+        return self.guild.get_channel(channel_id)
+
+    def get_all_channels(self):
+        return iter(self.guild.text_channels)
+
+
+def _merge(target: t.Dict[str, t.Any], doc: t.Dict[str, t.Any]) -> None:
+    # partial update merges objects recursively the same as ES does, other values are replaced
+    for key, value in doc.items():
+        if isinstance(value, dict) and isinstance(target.get(key), dict):
+            _merge(target[key], value)
+        else:
+            target[key] = value
+
+
+def _apply_script(doc: t.Dict[str, t.Any], script: t.Dict[str, t.Any]) -> None:
+    # painless scripts of the writer and gateway reaction events, the others are acknowledged as no-op
+    params = script.get('params', dict())
+    if script['source'] == FIELDS_REPLACE_SCRIPT:
+        doc.update(params['fields'])
+    elif script['source'] == REACTION_CLEAR_SCRIPT:
+        doc.update(reactions_dict=dict(), reactions_img_dict=dict())
+    elif script['source'] == REACTION_UPDATE_SCRIPT:
+        reactions, images = doc.setdefault('reactions_dict', dict()), doc.setdefault('reactions_img_dict', dict())
+        count = images.get(params['img'], 0) + params['delta']
+        if count > 0:
+            reactions[params['name']] = images[params['img']] = count
+        else:
+            reactions.pop(params['name'], None)
+            images.pop(params['img'], None)
+
+
+class FakeElasticsearch:
+    """
+    stand-in for AsyncElasticsearch recording bulk requests;
+    `latency_ms` simulates cluster round trip, `on_doc` is called with id of every written doc
+    """
+    def __init__(self, latency_ms: float = 0, on_doc: t.Optional[t.Callable[[str], None]] = None) -> None:
+        self.transport = SimpleNamespace(serializer=JSONSerializer())
+        self.latency = latency_ms / 1000
+        self.on_doc = on_doc
+        self.requests = Counter()
+        self.bulk_sizes: t.List[int] = list()
+        self.ops = Counter()  # bulk items by op type
+        self.docs: t.Dict[str, t.Any] = dict()
+
+    async def bulk(self, body, **kwargs) -> t.Dict[str, t.Any]:
+        self.requests['bulk'] += 1
+        await asyncio.sleep(self.latency)
+        serializer = self.transport.serializer
+        if isinstance(body, str):
+            body = body.encode()
+        lines = [serializer.loads(_) for _ in body.split(b'\n') if _]
+        items = list()
+        for action, source in zip(lines[::2], lines[1::2]):
+            op_type, meta = next(iter(action.items()))
+            self.ops[op_type] += 1
+            if op_type != 'update':
+                self.docs[meta['_id']] = source
+            elif meta['_id'] in self.docs and 'doc' in source:
+                _merge(self.docs[meta['_id']], source['doc'])
+            elif meta['_id'] in self.docs:
+                _apply_script(self.docs[meta['_id']], source['script'])
+            elif meta['_id'] not in self.docs:
+                items.append({op_type: {'_id': meta['_id'], 'status': 404, 'error': {'type': 'document_missing'}}})
+                continue
+            if self.on_doc is not None:
+                self.on_doc(meta['_id'])
+            item = {'_id': meta['_id'], 'status': 200}
+            if op_type == 'update' and source.get('_source'):
+                doc = self.docs[meta['_id']]
+                item['get'] = {'_source': {_: doc[_] for _ in source['_source'] if _ in doc}}
+            items.append({op_type: item})
+        self.bulk_sizes.append(len(items))
+        return {'took': 0, 'errors': any(_.get('error') for item in items for _ in item.values()), 'items': items}
+
+    async def search(self, **kwargs) -> t.Dict[str, t.Any]:
+        self.requests['search'] += 1
+        await asyncio.sleep(self.latency)
+        return {'hits': {'total': {'value': 0}, 'hits': []}}
+
+    async def count(self, **kwargs) -> t.Dict[str, t.Any]:
+        self.requests['count'] += 1
+        await asyncio.sleep(self.latency)
+        return {'count': len(self.docs)}
+
+    async def update_by_query(self, **kwargs) -> t.Dict[str, t.Any]:
+        self.requests['update_by_query'] += 1
+        return {'task': 'fake'}
+
+    async def close(self) -> None:
+        pass
+
+
+class FakeKafkaProducer:
+    """
+    stand-in for AIOKafkaProducer keeping produced messages per topic;
+    `latency_ms` simulates broker acknowledgement of every delivery, `fail_rate` - share of failed deliveries
+    """
+    def __init__(self, latency_ms: float = 0, fail_rate: float = 0) -> None:
+        self.latency = latency_ms / 1000
+        self.fail_rate = fail_rate
+        self.messages: t.Dict[str, t.List[t.Tuple[bytes, bytes]]] = dict()
+        self._sent = 0
+
+    async def start(self) -> None:
+        pass
+
+    async def stop(self) -> None:
+        pass
+
+    async def _deliver(self, topic: str, key: bytes, value: bytes) -> None:
+        await asyncio.sleep(self.latency)
+        self._sent += 1
+        if self.fail_rate and self._sent % int(1 / self.fail_rate) == 0:
+            raise ConnectionError('fake broker is unavailable')
+        self.messages.setdefault(topic, list()).append((key, value))
+
+    async def send(self, topic: str, value: bytes, key: bytes) -> asyncio.Future:
+        return asyncio.ensure_future(self._deliver(topic, key, value))
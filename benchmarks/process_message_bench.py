@@ -0,0 +1,90 @@
+"""
+micro-benchmark of process_message() on a synthetic corpus, compares it with the original implementation
+
+    python -m benchmarks.process_message_bench --messages 20000 --channels 50
+"""
+import re
+import time
+import asyncio
+import argparse
+
+import emoji
+import discord
+from datetime import datetime
+
+from benchmarks.synthetic import make_corpus
+from utils import process_message
+
+
+async def legacy_process_message(message):
+    """
+    process_message() as it was before the fast path, kept here as the baseline
+    """
+    _channel = message.channel
+    _thread = None
+    if hasattr(message.channel, 'parent'):
+        _channel = message.channel.parent
+        _thread = message.channel
+
+    _message = {
+         'message_id': message.id,
+         'server_name': message.guild.name,
+         'server_id': message.guild.id,
+         'sender_id': message.author.id,
+         'sender_username': message.author.name,
+         'sender_display_name': message.author.display_name,
+         'sender_is_bot': message.author.bot,
+         'sender_roles': [_.name for _ in message.author.roles] if isinstance(message.author, discord.Member) else [],
+         'channel_id': _channel.id,
+         'channel_title': _channel.name,
+         'channel_category': _channel.category.name if _channel.category else None,
+         'channel_category_id': _channel.category_id,
+         'thread_id': _thread.id if _thread else None,
+         'thread_title': _thread.name if _thread else None,
+         'thread_category': _thread.category.name if _thread and _thread.category else None,
+         'thread_category_id': _thread.category_id if _thread else None,
+         'text': message.content,
+         'raw_text': message.clean_content if hasattr(message, "clean_content") else "",
+         'emoji_list': [emoji.EMOJI_DATA[_]['en'] for _ in emoji.distinct_emoji_list(message.content)],
+         'emoji_img_list': [_ for _ in emoji.distinct_emoji_list(message.content)],
+         'cashtag_list': re.findall(r'\${1}\b([a-zA-Z]{2,})', message.content),
+         'timestamp': message.created_at.replace(microsecond=0).replace(tzinfo=None),
+         'computed_at': datetime.utcnow().replace(microsecond=0),
+         'is_reply': True if message.type.name == 'reply' else False,
+         'reply_to_msg': message.reference.message_id if message.reference else None,
+         'mentions': message.raw_mentions,
+         'reactions_dict': {emoji.EMOJI_DATA[_.emoji]['en']: _.count for _ in message.reactions if isinstance(_.emoji, str)},
+         'reactions_img_dict': {_.emoji: _.count for _ in message.reactions if isinstance(_.emoji, str)},
+         'media': [a.url for a in message.attachments] if message.attachments else []
+    }
+    return message.id, _message
+
+
+async def measure(process, corpus, repeat: int) -> float:
+    best = float('inf')
+    for _ in range(repeat):
+        started_at = time.perf_counter()
+        for message in corpus:
+            await process(message)
+        best = min(best, time.perf_counter() - started_at)
+    return len(corpus) / best
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--messages', type=int, default=20000)
+    parser.add_argument('--channels', type=int, default=50)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    corpus = make_corpus(args.messages, args.channels)
+    before = asyncio.run(measure(legacy_process_message, corpus, args.repeat))
+    after = asyncio.run(measure(process_message, corpus, args.repeat))
+    print(f'{"implementation":<16}{"messages/sec":>14}')
+    print(f'{"before":<16}{before:>14.0f}')
+    print(f'{"after":<16}{after:>14.0f}')
+    print(f'speedup x{after / before:.2f}')
+
+
+if __name__ == '__main__':
+    main()
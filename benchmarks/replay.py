@@ -0,0 +1,164 @@
+"""
+offline replay harness: drives main.py coroutines(history, updates, stream and consumer)
+against a fake Discord client with synthetic messages and an in-process ES stub
+
+    python -m benchmarks.replay --channels 50 --history 20000 --rate 2000 --duration 10
+"""
+import os
+import time
+import random
+import asyncio
+import argparse
+import tempfile
+import typing as t
+
+os.environ.setdefault('LOG_LEVEL', '40')  # collectors are chatty, only errors are interesting here
+
+from benchmarks.synthetic import make_guild, make_message, fill_history  # noqa: E402
+from benchmarks.fakes import FakeClient, FakeElasticsearch, FakeKafkaProducer  # noqa: E402
+from dedup import DigestCache  # noqa: E402
+from checkpoints import CheckpointStore  # noqa: E402
+from spool import Spool  # noqa: E402
+from writer import BulkWriter  # noqa: E402
+from sinks import KafkaSink, FileSink  # noqa: E402
+from scheduler import UpdateScheduler  # noqa: E402
+from overflow import StreamOverflow  # noqa: E402
+from constants import QUEUE_SIZE_MULTIPLIER  # noqa: E402
+from main import collect_history, collect_updates, stream_channels, track_guild_metadata, consumer  # noqa: E402
+
+
+def percentile(values: t.List[float], q: float) -> float:
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    return values[min(int(len(values) * q), len(values) - 1)]
+
+
+async def replay(args: argparse.Namespace) -> t.Dict[str, t.Any]:
+    guild = make_guild(args.channels, seed=args.seed)
+    fill_history(guild, args.history, seed=args.seed)
+    client = FakeClient(guild)
+    channels = {_.id: _.name for _ in guild.text_channels}
+
+    sent_at, latencies = dict(), list()
+
+    def on_doc(doc_id: str) -> None:
+        started_at = sent_at.pop(str(doc_id), None)
+        if started_at is not None:
+            latencies.append(time.perf_counter() - started_at)
+
+    es = FakeElasticsearch(latency_ms=args.es_latency_ms, on_doc=on_doc)
+    dedup = DigestCache()
+    checkpoints = CheckpointStore(':memory:')
+    spool = Spool(tempfile.mkdtemp(prefix='replay-spool-')) if args.spool else None
+    producer = FakeKafkaProducer(latency_ms=args.sink_latency_ms)
+    sinks = {
+        'kafka': lambda: KafkaSink('discord_messages', producer=producer),
+        'file': lambda: FileSink(tempfile.mkdtemp(prefix='replay-sink-')),
+    }
+    writer = BulkWriter(es, dedup=dedup, spool=spool, checkpoints=checkpoints,
+                        sinks=[sinks[_]() for _ in args.sinks.split(',') if _])
+    q = asyncio.Queue(maxsize=len(channels) * QUEUE_SIZE_MULTIPLIER)
+    scheduler = UpdateScheduler({_: guild.name for _ in channels})
+    overflow = StreamOverflow(q, args.overflow, spill_dir=tempfile.mkdtemp(prefix='replay-spill-'))
+
+    async def _history() -> float:
+        started_at = time.perf_counter()
+        await collect_history(client, es, writer, channels, dedup, checkpoints)
+        return time.perf_counter() - started_at
+
+    background = [asyncio.ensure_future(_) for _ in (
+        writer.run(),
+        overflow.run(),
+        collect_updates(client, es, writer, channels, dedup, checkpoints, scheduler),
+        stream_channels(client, channels, scheduler, overflow),
+        track_guild_metadata(client),
+    )]
+    history = asyncio.ensure_future(_history())
+    consuming = asyncio.gather(*[consumer(q, writer, dedup) for _ in range(args.consumers)])
+    await asyncio.sleep(0)  # let stream_channels register on_message handler
+
+    rnd, depths, put_waits = random.Random(args.seed), list(), list()
+    n_messages = int(args.rate * args.duration)
+    started_at = time.perf_counter()
+    for i in range(n_messages):
+        message = make_message(guild, 2 * 10 ** 17 + i, rnd)
+        message.channel.messages.append(message)  # streamed messages are in channel history as well
+        sent_at[str(message.id)] = dispatched_at = time.perf_counter()
+        await client.dispatch('message', message)
+        put_waits.append(time.perf_counter() - dispatched_at)
+        depths.append(q.qsize())
+        await asyncio.sleep(max(started_at + (i + 1) / args.rate - time.perf_counter(), 0))
+    produced_in = time.perf_counter() - started_at
+
+    # spilled and coalesced messages come back through consumers and updates polls
+    deadline = time.perf_counter() + args.drain_timeout
+    while sent_at and time.perf_counter() < deadline:
+        await asyncio.sleep(0.01)
+    for _ in range(args.consumers):
+        await q.put(None)  # consumers flush the last batch and stop
+    await consuming
+    total_time = time.perf_counter() - started_at
+    history_time = await history
+
+    for task in background:
+        task.cancel()
+    await asyncio.gather(*background, return_exceptions=True)
+    await writer.close()
+
+    return {
+        'history_messages': args.history,
+        'history_time': history_time,
+        'stream_messages': n_messages,
+        'produce_rate': n_messages / produced_in if produced_in else float('nan'),
+        'stream_throughput': len(latencies) / total_time if total_time else float('nan'),
+        'lost': len(sent_at),
+        'latencies': latencies,
+        'put_waits': put_waits,
+        'depths': depths,
+        'es_requests': dict(es.requests),
+        'bulk_sizes': es.bulk_sizes,
+        'bulk_ops': dict(es.ops),
+        'dedup_hit_rate': dedup.hit_rate,
+        'kafka_messages': sum(len(_) for _ in producer.messages.values()),
+    }
+
+
+def report(result: t.Dict[str, t.Any]) -> None:
+    latencies = [_ * 1000 for _ in result['latencies']]
+    put_waits = [_ * 1000 for _ in result['put_waits']]
+    depths, bulk_sizes = result['depths'], result['bulk_sizes']
+    print(f"history      {result['history_messages']} messages in {result['history_time']:.2f}s "
+          f"({result['history_messages'] / result['history_time']:.0f} msg/s)")
+    print(f"stream       {result['stream_messages']} messages, produced {result['produce_rate']:.0f} msg/s, "
+          f"indexed {result['stream_throughput']:.0f} msg/s, lost {result['lost']}")
+    print(f"e2e latency  p50 {percentile(latencies, 0.5):.1f}ms  p95 {percentile(latencies, 0.95):.1f}ms  "
+          f"p99 {percentile(latencies, 0.99):.1f}ms  max {max(latencies, default=float('nan')):.1f}ms")
+    print(f"queue put    p99 {percentile(put_waits, 0.99):.2f}ms  max {max(put_waits, default=float('nan')):.2f}ms")
+    print(f"queue depth  avg {sum(depths) / max(len(depths), 1):.1f}  max {max(depths, default=0)}")
+    print(f"es requests  {result['es_requests']}, avg bulk size {sum(bulk_sizes) / max(len(bulk_sizes), 1):.0f}, "
+          f"ops {result['bulk_ops']}")
+    print(f"dedup        hit rate {result['dedup_hit_rate']:.2%}")
+    print(f"kafka        {result['kafka_messages']} messages produced")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--channels', type=int, default=50)
+    parser.add_argument('--history', type=int, default=20000, help='history messages spread over all channels')
+    parser.add_argument('--rate', type=float, default=2000, help='streamed messages per second')
+    parser.add_argument('--duration', type=float, default=10, help='seconds of streaming')
+    parser.add_argument('--es-latency-ms', type=float, default=5, help='simulated ES round trip')
+    parser.add_argument('--spool', action='store_true', help='write through on-disk spool')
+    parser.add_argument('--overflow', default='spill', choices=['spill', 'drop', 'coalesce', 'block'],
+                        help='stream queue overflow policy')
+    parser.add_argument('--consumers', type=int, default=4, help='stream queue consumer workers')
+    parser.add_argument('--sinks', default='', help='secondary sinks fed along with ES: kafka,file')
+    parser.add_argument('--sink-latency-ms', type=float, default=1, help='simulated Kafka broker acknowledgement')
+    parser.add_argument('--drain-timeout', type=float, default=30)
+    parser.add_argument('--seed', type=int, default=0)
+    report(asyncio.run(replay(parser.parse_args())))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+"""
+restart check: startup history, streamed messages and an updates poll advance checkpoints,
+so history collected after restart continues from them instead of re-collecting everything since the previous start;
+exits with status 1 if it doesn't
+
+    python -m benchmarks.restart --channels 10 --history 2000 --stream 200
+"""
+import os
+import sys
+import time
+import random
+import asyncio
+import argparse
+import tempfile
+import typing as t
+
+os.environ.setdefault('LOG_LEVEL', '40')  # collectors are chatty, only errors are interesting here
+
+from benchmarks.synthetic import make_guild, make_message, fill_history  # noqa: E402
+from benchmarks.fakes import FakeClient, FakeElasticsearch  # noqa: E402
+from dedup import DigestCache  # noqa: E402
+from checkpoints import CheckpointStore  # noqa: E402
+from writer import BulkWriter  # noqa: E402
+from utils import process_message  # noqa: E402
+from main import collect_history, _collect_unread_from_channels, consumer  # noqa: E402
+
+
+async def run(args: argparse.Namespace, db: str) -> t.Dict[str, t.Any]:
+    guild = make_guild(args.channels, seed=args.seed)
+    fill_history(guild, args.history, seed=args.seed)
+    client = FakeClient(guild)
+    channels = {_.id: _.name for _ in guild.text_channels}
+    rnd = random.Random(args.seed)
+
+    # the first run: startup history, stream and an updates poll catching a message missed by the stream
+    es, dedup, checkpoints = FakeElasticsearch(), DigestCache(), CheckpointStore(db)
+    writer = BulkWriter(es, dedup=dedup, checkpoints=checkpoints)
+    started_at = time.monotonic()
+    await collect_history(client, es, writer, channels, dedup, checkpoints)
+    q = asyncio.Queue()
+    for i in range(args.stream):
+        message = make_message(guild, 2 * 10 ** 17 + i, rnd)
+        message.channel.messages.append(message)
+        await q.put((time.monotonic(), *await process_message(message)))
+    missed = make_message(guild, 2 * 10 ** 17 + args.stream, rnd)
+    missed.channel.messages.append(missed)
+    await q.put(None)
+    await consumer(q, writer, dedup)
+    window = time.monotonic() - started_at + 1  # updates window since the startup history
+    await _collect_unread_from_channels(client, es, writer, channels, dedup, checkpoints,
+                                        {_: window for _ in channels})
+    await writer.close()
+    checkpoint = checkpoints.get(missed.channel.id)
+    checkpoints.close()
+
+    # restart: fresh ES stub and dedup cache, the same checkpoint database
+    restarted_es, dedup, checkpoints = FakeElasticsearch(), DigestCache(), CheckpointStore(db)
+    writer = BulkWriter(restarted_es, dedup=dedup, checkpoints=checkpoints)
+    await collect_history(client, restarted_es, writer, channels, dedup, checkpoints)
+    await writer.close()
+    checkpoints.close()
+    return {
+        'missed_indexed': missed.id in es.docs,
+        'missed_checkpointed': checkpoint is not None and checkpoint[0] >= missed.id,
+        'recollected': restarted_es.ops['index'],
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--channels', type=int, default=10)
+    parser.add_argument('--history', type=int, default=2000, help='history messages spread over all channels')
+    parser.add_argument('--stream', type=int, default=200, help='streamed messages')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory(prefix='restart-') as directory:
+        result = asyncio.run(run(args, os.path.join(directory, 'checkpoints.db')))
+    print(f"missed by stream  indexed by updates poll {result['missed_indexed']}, "
+          f"checkpoint advanced {result['missed_checkpointed']}")
+    print(f"after restart     {result['recollected']} messages re-collected")
+    if not (result['missed_indexed'] and result['missed_checkpointed'] and result['recollected'] == 0):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
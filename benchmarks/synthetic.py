@@ -0,0 +1,175 @@
+"""
+synthetic discord objects for offline benchmarks;
+they mimic only the attributes read by the scraper, costly discord.py properties(category, member roles)
+are resolved the same way discord.py does it
+"""
+import os
+import random
+import typing as t
+
+from types import SimpleNamespace
+from datetime import datetime, timedelta, timezone
+
+# constants.py refuses to load without these, benchmarks never talk to Discord or ES
+for _name, _value in (('BOT_TOKEN', 'benchmark'), ('GUILD', 'benchmark'), ('CHANNELS', '1'),
+                      ('ELASTICSEARCH_PORT', '9200'), ('INDEX', 'benchmark')):
+    os.environ.setdefault(_name, _value)
+
+import discord  # noqa: E402
+
+
+WORDS = ['gm', 'wen', 'moon', 'the', 'chart', 'looks', 'bullish', 'bearish', 'pump', 'dump', 'airdrop', 'ser',
+         'anyone', 'knows', 'when', 'listing', 'is', 'happening', 'ngmi', 'wagmi', 'lfg', 'ok', 'lol', 'fud']
+CASHTAGS = ['$BTC', '$ETH', '$SAN', '$sol', '$DOGE']
+EMOJIS = ['🚀', '👍', '🔥', '😂', '❤️', '🇺🇸', '👍🏽', '👀', '💎', '🙌']
+
+
+class SyntheticRole(SimpleNamespace):
+    def __lt__(self, other):
+        return (self.position, self.id) < (other.position, other.id)
+
+
+class SyntheticGuild(SimpleNamespace):
+    def get_role(self, role_id: int):
+        return self.roles.get(role_id)
+
+    def get_channel(self, channel_id: int):
+        return self.channels.get(channel_id)
+
+    @property
+    def default_role(self):
+        return self.roles[self.id]
+
+
+class HistoryMixin:
+    """
+    channel.history() over pre-generated `messages`, oldest first like discord.py does with `after`
+    """
+    async def history(
+        self,
+        limit: t.Optional[int] = None,
+        after: t.Union[datetime, discord.Object, None] = None,
+        oldest_first: t.Optional[bool] = None
+    ):
+        if isinstance(after, discord.Object):
+            messages = [_ for _ in self.messages if _.id > after.id]
+        else:
+            if after is not None and after.tzinfo is None:
+                after = after.replace(tzinfo=timezone.utc)
+            messages = [_ for _ in self.messages if after is None or _.created_at > after]
+        for message in messages[:limit]:
+            yield message
+
+
+class SyntheticChannel(HistoryMixin, SimpleNamespace):
+    @property
+    def category(self):
+        return self.guild.get_channel(self.category_id) if self.category_id else None
+
+
+class SyntheticThread(HistoryMixin, SimpleNamespace):
+    @property
+    def category_id(self):
+        return self.parent.category_id
+
+    @property
+    def category(self):
+        return self.parent.category
+
+
+class SyntheticMember(discord.Member):
+    """
+    passes isinstance(_, discord.Member) checks, roles are resolved and sorted on every access like in discord.py
+    """
+    def __init__(self, member_id: int, name: str, guild: SyntheticGuild, role_ids: t.List[int]) -> None:
+        self.__dict__.update(_id=member_id, _name=name, _guild=guild, _role_ids=role_ids)
+
+    id = property(lambda self: self.__dict__['_id'])
+    name = property(lambda self: self.__dict__['_name'])
+    display_name = property(lambda self: self.__dict__['_name'].title())
+    bot = property(lambda self: False)
+    guild = property(lambda self: self.__dict__['_guild'])
+
+    @property
+    def roles(self):
+        result = [self.guild.get_role(_) for _ in self.__dict__['_role_ids']]
+        result.append(self.guild.default_role)
+        result.sort()
+        return result
+
+
+def make_guild(n_channels: int, n_members: int = 500, n_roles: int = 30, seed: int = 0) -> SyntheticGuild:
+    rnd = random.Random(seed)
+    guild = SyntheticGuild(id=1, name='benchmark', roles=dict(), channels=dict())
+    for position, role_id in enumerate([guild.id] + list(range(100, 100 + n_roles))):
+        guild.roles[role_id] = SyntheticRole(id=role_id, name=f'role-{role_id}', position=position)
+    for category_id in range(10, 15):
+        guild.channels[category_id] = SimpleNamespace(id=category_id, name=f'category-{category_id}')
+    guild.text_channels = list()
+    for channel_id in range(1000, 1000 + n_channels):
+        channel = SyntheticChannel(id=channel_id, name=f'channel-{channel_id}', guild=guild,
+                                   category_id=rnd.choice([None, 10, 11, 12, 13, 14]), threads=list(),
+                                   messages=list())
+        thread = SyntheticThread(id=channel_id * 10, name=f'thread-{channel_id}', parent=channel,
+                                 parent_id=channel_id, guild=guild, messages=list())
+        channel.threads.append(thread)
+        guild.channels[channel_id] = channel
+        guild.channels[thread.id] = thread
+        guild.text_channels.append(channel)
+    guild.members = [SyntheticMember(10000 + _, f'user{_}', guild, rnd.sample(list(guild.roles)[1:], 4))
+                     for _ in range(n_members)]
+    return guild
+
+
+def make_text(rnd: random.Random) -> str:
+    words = rnd.choices(WORDS, k=rnd.randint(3, 25))
+    kind = rnd.random()
+    if kind < 0.15:
+        words.insert(rnd.randrange(len(words)), rnd.choice(CASHTAGS))
+    elif kind < 0.3:
+        words.extend(rnd.choices(EMOJIS, k=rnd.randint(1, 3)))
+    return ' '.join(words)
+
+
+def make_message(guild: SyntheticGuild, message_id: int, rnd: random.Random, created_at: datetime = None):
+    channel = rnd.choice(guild.text_channels)
+    if rnd.random() < 0.2:
+        channel = channel.threads[0]
+    text = make_text(rnd)
+    reactions = [SimpleNamespace(emoji=_, count=rnd.randint(1, 20))
+                 for _ in rnd.sample(EMOJIS, rnd.choice([0, 0, 0, 1, 2, 3]))]
+    return SimpleNamespace(
+        id=message_id,
+        guild=guild,
+        channel=channel,
+        author=rnd.choice(guild.members),
+        content=text,
+        clean_content=text,
+        created_at=created_at or datetime.now(timezone.utc),
+        edited_at=None,
+        type=SimpleNamespace(name='reply' if rnd.random() < 0.1 else 'default'),
+        reference=None,
+        raw_mentions=[],
+        reactions=reactions,
+        attachments=[SimpleNamespace(url=f'https://cdn.example/{message_id}.png')] if rnd.random() < 0.05 else [],
+    )
+
+
+def make_corpus(
+    n_messages: int,
+    n_channels: int,
+    seed: int = 0,
+    guild: t.Optional[SyntheticGuild] = None
+) -> t.List[SimpleNamespace]:
+    rnd = random.Random(seed)
+    guild = guild or make_guild(n_channels, seed=seed)
+    start = datetime.now(timezone.utc) - timedelta(seconds=n_messages)
+    return [make_message(guild, 10 ** 17 + _, rnd, start + timedelta(seconds=_)) for _ in range(n_messages)]
+
+
+def fill_history(guild: SyntheticGuild, n_messages: int, seed: int = 0) -> None:
+    """
+    spreads `n_messages` over channels and threads history, one message per second up to now
+    """
+    for message in make_corpus(n_messages, len(guild.text_channels), seed=seed, guild=guild):
+        message.channel.messages.append(message)
@@ -0,0 +1,218 @@
+import asyncio
+import sqlite3
+import threading
+import typing as t
+
+from datetime import datetime
+
+from logger import log
+from constants import CHECKPOINT_DB
+
+
+class PassProgress:
+    """
+    what a history/updates/backfill pass collected contiguously per channel/thread: when collecting started
+    and the newest message seen, whether it was written, refreshed or skipped as unchanged;
+    committed to checkpoints by BulkWriter.commit() once messages of the pass are written
+    """
+    def __init__(self) -> None:
+        self.started: t.Dict[int, t.Tuple[datetime, int]] = dict()  # channel_id -> (started_at, docs dropped before)
+        self.newest: t.Dict[int, t.Tuple[int, t.Union[str, datetime]]] = dict()
+        self.done: t.Set[int] = set()
+
+    def start(self, channel_id: int, dropped: int) -> None:
+        self.started[channel_id] = (datetime.utcnow(), dropped)
+
+    def see(self, channel_id: int, message_id: int, timestamp: t.Union[str, datetime]) -> None:
+        newest = self.newest.get(channel_id)
+        if newest is None or message_id > newest[0]:
+            self.newest[channel_id] = (message_id, timestamp)
+
+    def finish(self, channel_id: int) -> None:
+        self.done.add(channel_id)
+
+
+class CheckpointStore:
+    """
+    last collected message id and timestamp per channel and thread, kept in local SQLite, along with the time
+    the channel/thread is collected through: all messages created before it were seen by a contiguous pass;
+    all checkpoints are read with one query by load() in background, so streaming doesn't wait for it,
+    then they are advanced after ES acknowledges a batch and once a contiguous pass is written;
+    pagination cursors of archived threads crawl are kept in the same database
+    """
+    def __init__(self, path: str = CHECKPOINT_DB) -> None:
+        self._path = path
+        self._db = sqlite3.connect(path, check_same_thread=False)  # reads and writes are done in executor
+        self._db_lock = threading.Lock()
+        self._checkpoints: t.Dict[int, t.Tuple[int, datetime]] = dict()
+        self._through: t.Dict[int, datetime] = dict()
+        self._cursors: t.Dict[t.Tuple[int, str], t.Tuple[t.Optional[datetime], t.Optional[datetime], bool]] = dict()
+        self._loading: t.Optional[asyncio.Future] = None
+
+    async def load(self) -> None:
+        """
+        reads all checkpoints once, the first call starts reading and every call waits till it's done;
+        collectors call it before they use checkpoints
+        """
+        if self._loading is None:
+            self._loading = asyncio.get_running_loop().run_in_executor(None, self._load)
+        await asyncio.shield(self._loading)
+
+    def _load(self) -> None:
+        with self._db_lock, self._db:
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS checkpoints '
+                '(channel_id INTEGER PRIMARY KEY, message_id INTEGER NOT NULL, timestamp TEXT NOT NULL)'
+            )
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS collected (channel_id INTEGER PRIMARY KEY, through TEXT NOT NULL)'
+            )
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS thread_cursors (channel_id INTEGER NOT NULL, kind TEXT NOT NULL, '
+                'newest TEXT, before TEXT, done INTEGER NOT NULL, PRIMARY KEY (channel_id, kind))'
+            )
+            rows = self._db.execute('SELECT channel_id, message_id, timestamp FROM checkpoints').fetchall()
+            through_rows = self._db.execute('SELECT channel_id, through FROM collected').fetchall()
+            cursor_rows = self._db.execute('SELECT channel_id, kind, newest, before, done FROM thread_cursors').fetchall()
+        self._checkpoints.update(
+            (channel_id, (message_id, datetime.fromisoformat(timestamp))) for channel_id, message_id, timestamp in rows
+        )
+        self._through.update((channel_id, datetime.fromisoformat(through)) for channel_id, through in through_rows)
+        self._cursors.update(
+            ((channel_id, kind), (_parse_dt(newest), _parse_dt(before), bool(done)))
+            for channel_id, kind, newest, before, done in cursor_rows
+        )
+        log.info(f'Loaded {len(self._checkpoints)} channel/thread checkpoints '
+                 f'and {len(self._cursors)} archived threads cursors from {self._path}')
+
+    def get(self, channel_id: int) -> t.Optional[t.Tuple[int, datetime]]:
+        """
+        (message_id, timestamp) of the last acknowledged message of channel or thread
+        """
+        return self._checkpoints.get(channel_id)
+
+    def collected_through(self, channel_id: int) -> t.Optional[datetime]:
+        """
+        start time of the last contiguous pass over channel or thread, messages created before it are collected
+        """
+        return self._through.get(channel_id)
+
+    def resume_at(self, channel_id: int) -> t.Optional[datetime]:
+        """
+        time history of channel or thread continues from, the later of the checkpointed message and collected_through
+        """
+        checkpoint, through = self._checkpoints.get(channel_id), self._through.get(channel_id)
+        return max([_ for _ in (checkpoint[1] if checkpoint else None, through) if _ is not None], default=None)
+
+    def covers(self, channel_id: int, dt_from: datetime) -> bool:
+        """
+        whether collecting from `dt_from` is contiguous with the previous passes, only then checkpoint could be
+        advanced without skipping the messages in between
+        """
+        through = self._through.get(channel_id)
+        return through is not None and through >= dt_from
+
+    async def advance(self, actions: t.Iterable[t.Dict[str, t.Any]]) -> None:
+        """
+        moves checkpoints forward to the newest acknowledged messages marked with `_checkpoint` key
+        """
+        await self.load()  # docs replayed from spool on start can be acknowledged before collectors load it
+        updates = dict()
+        for action in actions:
+            channel_id = action.get('_checkpoint')
+            source = action.get('_source')
+            if channel_id is None or not source:  # message failed to be processed, it has no id and timestamp
+                continue
+            message_id = int(source['message_id'])
+            current = updates.get(channel_id) or self._checkpoints.get(channel_id)
+            if current is None or message_id > current[0]:
+                updates[channel_id] = (message_id, _as_datetime(source['timestamp']))
+        if not updates:
+            return
+        self._checkpoints.update(updates)
+        await asyncio.get_running_loop().run_in_executor(None, self._save, updates, dict())
+
+    async def collect(self, progress: PassProgress, channel_ids: t.Iterable[int]) -> None:
+        """
+        moves checkpoints and collected_through of channels/threads forward to what the pass has collected
+        """
+        await self.load()
+        updates, through = dict(), dict()
+        for channel_id in channel_ids:
+            newest, current = progress.newest.get(channel_id), self._checkpoints.get(channel_id)
+            if newest is not None and (current is None or newest[0] > current[0]):
+                updates[channel_id] = (newest[0], _as_datetime(newest[1]))
+            started_at = progress.started[channel_id][0]
+            if channel_id not in self._through or started_at > self._through[channel_id]:
+                through[channel_id] = started_at
+        if not updates and not through:
+            return
+        self._checkpoints.update(updates)
+        self._through.update(through)
+        await asyncio.get_running_loop().run_in_executor(None, self._save, updates, through)
+
+    def _save(self, updates: t.Dict[int, t.Tuple[int, datetime]], through: t.Dict[int, datetime]) -> None:
+        try:
+            with self._db_lock, self._db:
+                self._db.executemany(
+                    'INSERT INTO collected (channel_id, through) VALUES (?, ?) ON CONFLICT(channel_id) '
+                    'DO UPDATE SET through = excluded.through WHERE excluded.through > collected.through',
+                    [(_, _through.isoformat()) for _, _through in through.items()]
+                )
+                self._db.executemany(
+                    'INSERT INTO checkpoints (channel_id, message_id, timestamp) VALUES (?, ?, ?) '
+                    'ON CONFLICT(channel_id) DO UPDATE SET message_id = excluded.message_id, '
+                    'timestamp = excluded.timestamp WHERE excluded.message_id > checkpoints.message_id',
+                    [(_, message_id, timestamp.isoformat()) for _, (message_id, timestamp) in updates.items()]
+                )
+        except sqlite3.Error as e:
+            log.error(f'Failed to save {len(updates) + len(through)} checkpoints: {e}')
+
+    def get_cursor(
+        self,
+        channel_id: int,
+        kind: str
+    ) -> t.Optional[t.Tuple[t.Optional[datetime], t.Optional[datetime], bool]]:
+        """
+        (newest, before, done) of archived threads crawl of channel: archive time of the newest crawled thread,
+        archive time to continue the crawl before and whether the crawl reached the oldest thread
+        """
+        return self._cursors.get((channel_id, kind))
+
+    async def save_cursor(
+        self,
+        channel_id: int,
+        kind: str,
+        newest: t.Optional[datetime],
+        before: t.Optional[datetime],
+        done: bool
+    ) -> None:
+        self._cursors[(channel_id, kind)] = (newest, before, done)
+        await asyncio.get_running_loop().run_in_executor(
+            None, self._save_cursor, (channel_id, kind, _format_dt(newest), _format_dt(before), int(done))
+        )
+
+    def _save_cursor(self, row: t.Tuple[int, str, t.Optional[str], t.Optional[str], int]) -> None:
+        try:
+            with self._db_lock, self._db:
+                self._db.execute('INSERT OR REPLACE INTO thread_cursors (channel_id, kind, newest, before, done) '
+                                 'VALUES (?, ?, ?, ?, ?)', row)
+        except sqlite3.Error as e:
+            log.error(f'Failed to save archived threads cursor: {e}', extra={"channel_id": f"{row[0]}"})
+
+    def close(self) -> None:
+        with self._db_lock:
+            self._db.close()
+
+
+def _as_datetime(value: t.Union[str, datetime]) -> datetime:
+    # timestamps of processed messages are pre-formatted, docs replayed from spool are deserialized json
+    return datetime.fromisoformat(value) if isinstance(value, str) else value
+
+
+def _parse_dt(value: t.Optional[str]) -> t.Optional[datetime]:
+    return datetime.fromisoformat(value) if value else None
+
+
+def _format_dt(value: t.Optional[datetime]) -> t.Optional[str]:
+    return value.isoformat() if value else None
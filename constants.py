@@ -1,3 +1,4 @@
+import json
 import typing as t
 
 from os import getenv
@@ -23,14 +24,14 @@ def __history_datetime_setter(_history_datetime: str) -> t.Union[str, datetime]:
 
 
 def __bot_token_setter(_bot_token: str) -> str:
-    if not _bot_token:
+    if not _bot_token and not SCRAPER_CONFIG:
         raise ValueError(f'BOT_TOKEN is empty. Stop script')
     else:
         return _bot_token
 
 
 def __guild_setter(_guild: str) -> str:
-    if not _guild:
+    if not _guild and not SCRAPER_CONFIG:
         raise ValueError(f'GUILD is empty. Stop script')
     else:
         return _guild
@@ -39,6 +40,8 @@ def __guild_setter(_guild: str) -> str:
 def __channels_setter(_channels: str) -> list:
     # CHANNELS shouldn't be empty to not collect and store all msgs from all server channels including possible trash
     channels = list()
+    if not _channels and SCRAPER_CONFIG:
+        return channels
     if not _channels:
         raise ValueError(f'CHANNELS is empty. Stop script')
     for channel_id in set(_channels.split(',')):
@@ -53,20 +56,129 @@ def __channels_setter(_channels: str) -> list:
     return channels
 
 
+def __bots_setter(_scraper_config: str) -> t.List[t.Dict[str, t.Any]]:
+    """
+    bot connections with their guilds and channels, a single bot from BOT_TOKEN/GUILD/CHANNELS if no config is set:
+    {"bots": [{"name": "...", "token_env": "BOT_TOKEN_1", "sharded": false, "shard_count": null,
+               "guilds": {"<server_name>": [<channel1_id>, ...]}}]}
+    """
+    if not _scraper_config:
+        return [{'name': GUILD, 'token': BOT_TOKEN, 'sharded': False, 'shard_count': None, 'guilds': {GUILD: CHANNELS}}]
+    try:
+        with open(_scraper_config) as f:
+            config = json.load(f)
+        bots = list()
+        for i, bot in enumerate(config['bots']):
+            token = bot.get('token') or getenv(bot.get('token_env', ""), "")
+            name = bot.get('name') or f'bot{i}'
+            if not token:
+                raise ValueError(f'token of bot {name} is empty')
+            guilds = {str(guild): [int(_) for _ in channels] for guild, channels in bot['guilds'].items()}
+            if not guilds or not all(guilds.values()):
+                raise ValueError(f'guilds and channels of bot {name} should not be empty')
+            bots.append({
+                'name': name,
+                'token': token,
+                'sharded': bool(bot.get('sharded', False)),
+                'shard_count': bot.get('shard_count'),
+                'guilds': guilds
+            })
+    except Exception as e:
+        log.error(f'Error while parsing SCRAPER_CONFIG {_scraper_config}: {e}. Stop script')
+        raise
+    if not bots:
+        raise ValueError(f'SCRAPER_CONFIG has no bots. Stop script')
+    return bots
+
+
 SCRAPING_HISTORY_INTERVAL = 86400
-SCRAPING_UPDATES_INTERVAL = 300
+# edits/reactions/deletions come from gateway events, polling for updates is left only as a gap filler
+EVENT_DRIVEN_UPDATES = getenv('EVENT_DRIVEN_UPDATES', 'true').lower() == 'true'
+SCRAPING_UPDATES_INTERVAL = int(getenv('SCRAPING_UPDATES_INTERVAL', 3600 if EVENT_DRIVEN_UPDATES else 300))
+# updates polling adapts to channel activity: channel is polled once about UPDATES_TARGET_MESSAGES new messages
+# are expected by its stream rate, but not more often than UPDATES_MIN_INTERVAL and not less often than
+# SCRAPING_UPDATES_INTERVAL(0 - dormant channels are not polled); rate decays over UPDATES_RATE_WINDOW seconds
+UPDATES_MIN_INTERVAL = int(getenv('UPDATES_MIN_INTERVAL', 60))
+UPDATES_TARGET_MESSAGES = int(getenv('UPDATES_TARGET_MESSAGES', 100))
+UPDATES_RATE_WINDOW = int(getenv('UPDATES_RATE_WINDOW', 3600))
+# global budget of Discord API calls per minute spent on updates polling
+UPDATES_API_BUDGET = int(getenv('UPDATES_API_BUDGET', 60))
+UPDATES_SCHEDULER_TICK = 5
 QUEUE_SIZE_MULTIPLIER = 100
 MESSAGE_BATCH_SIZE = 1000
+MEMBER_ROLES_CACHE_SIZE = 100000
+
+# max number of channels/threads paginated concurrently during history and updates passes
+HISTORY_CONCURRENCY = int(getenv('HISTORY_CONCURRENCY', 10))
+# API requests per second of one bot handed out by request scheduler, a bit below Discord global limit of 50
+DISCORD_API_RATE = float(getenv('DISCORD_API_RATE', 45))
+
+# archived threads and forum posts are crawled once, then only the newly archived ones on every start;
+# threads of one page of archived threads API are collected concurrently
+ARCHIVED_THREADS_BACKFILL = getenv('ARCHIVED_THREADS_BACKFILL', 'true').lower() == 'true'
+ARCHIVED_THREADS_PAGE_SIZE = 100
+
+# dedup cache of message digests: max number of messages and seconds before digest expires
+DEDUP_CACHE_SIZE = int(getenv('DEDUP_CACHE_SIZE', 100000))
+DEDUP_CACHE_TTL = int(getenv('DEDUP_CACHE_TTL', 86400))
+
+# live stream bulk writer: batch is flushed when it reaches BULK_FLUSH_SIZE docs or BULK_FLUSH_INTERVAL_MS passed
+BULK_FLUSH_SIZE = int(getenv('BULK_FLUSH_SIZE', 500))
+BULK_FLUSH_INTERVAL_MS = int(getenv('BULK_FLUSH_INTERVAL_MS', 1000))
+
+# on-disk spool between message processing and ES, empty SPOOL_DIR disables it
+SPOOL_DIR = getenv('SPOOL_DIR', "spool")
+
+# what happens to streamed message when stream queue is full: spill(to disk under SPOOL_DIR), drop, coalesce
+# (into immediate updates poll of the channel) or block(event dispatch waits for consumers)
+STREAM_OVERFLOW_POLICY = getenv('STREAM_OVERFLOW_POLICY', "spill" if SPOOL_DIR else "coalesce").lower()
+if STREAM_OVERFLOW_POLICY not in ('spill', 'drop', 'coalesce', 'block'):
+    raise ValueError(f'Unknown STREAM_OVERFLOW_POLICY {STREAM_OVERFLOW_POLICY}. Stop script')
+if STREAM_OVERFLOW_POLICY == 'spill' and not SPOOL_DIR:
+    raise ValueError(f'STREAM_OVERFLOW_POLICY=spill requires SPOOL_DIR. Stop script')
+# number of consumer workers processing the stream queue
+STREAM_CONSUMERS = int(getenv('STREAM_CONSUMERS', 4))
+SPOOL_SEGMENT_SIZE = int(getenv('SPOOL_SEGMENT_SIZE', 16 * 1024 * 1024))
+SPOOL_MAX_SIZE = int(getenv('SPOOL_MAX_SIZE', 4 * 1024 * 1024 * 1024))
+SPOOL_RETRY_MAX_INTERVAL = 60
+
+# secondary sinks fed with the same processed messages as ES(kafka, file), each from its own spool under SPOOL_DIR,
+# or without spool from queue of SINK_QUEUE_SIZE batches, where failed batches are retried SINK_MAX_RETRIES times
+SINKS = [_.strip().lower() for _ in getenv('SINKS', "").split(',') if _.strip()]
+for _sink in SINKS:
+    if _sink not in ('kafka', 'file'):
+        raise ValueError(f'Unknown sink {_sink} in SINKS. Stop script')
+SINK_QUEUE_SIZE = int(getenv('SINK_QUEUE_SIZE', 100))
+SINK_MAX_RETRIES = int(getenv('SINK_MAX_RETRIES', 5))
+KAFKA_BOOTSTRAP_SERVERS = getenv('KAFKA_BOOTSTRAP_SERVERS', "localhost:9092")
+KAFKA_TOPIC = getenv('KAFKA_TOPIC', "discord_messages")
+FILE_SINK_DIR = getenv('FILE_SINK_DIR', "sink")
+
+# SQLite file with last collected message per channel/thread, should be on persistent volume like SPOOL_DIR
+CHECKPOINT_DB = getenv('CHECKPOINT_DB', "checkpoints.sqlite3")
 
 HEALTH_CHECK_INTERVAL = getenv('HEALTH_CHECK_INTERVAL', "")
+# seconds between background ES count refreshes, /health_check answers from the cached count
+HEALTH_COUNT_REFRESH_INTERVAL = int(getenv('HEALTH_COUNT_REFRESH_INTERVAL', 60))
 
 INDEX_NAME = getenv('INDEX', "")
 
 ELASTICSEARCH_HOST = getenv('ELASTICSEARCH_HOST', "")
 ELASTICSEARCH_PORT = int(getenv('ELASTICSEARCH_PORT', ""))
+# shared async ES client: max number of pooled connections and seconds to keep idle connection alive
+ES_CONNECTION_POOL_SIZE = int(getenv('ES_CONNECTION_POOL_SIZE', 10))
+ES_KEEPALIVE_TIMEOUT = float(getenv('ES_KEEPALIVE_TIMEOUT', 30))
+# gzip ES request bodies, saves network on bulk requests at the cost of CPU
+ES_HTTP_COMPRESS = getenv('ES_HTTP_COMPRESS', 'false').lower() == 'true'
 
 HISTORICAL_RUN_START_DATE = __history_datetime_setter(getenv('HISTORICAL_RUN_START_DATE', ""))
 
+# JSON file routing several guilds and bot tokens to one process, replaces BOT_TOKEN/GUILD/CHANNELS
+SCRAPER_CONFIG = getenv('SCRAPER_CONFIG', "")
+
 BOT_TOKEN = __bot_token_setter(getenv('BOT_TOKEN', ""))
 GUILD = __guild_setter(getenv('GUILD', ""))
 CHANNELS = __channels_setter(getenv('CHANNELS', ""))
+BOTS = __bots_setter(SCRAPER_CONFIG)
+# label of process-wide metrics and logs
+SCRAPER_NAME = getenv('SCRAPER_NAME', GUILD or "scraper")
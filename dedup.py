@@ -0,0 +1,87 @@
+import json
+import time
+import hashlib
+import typing as t
+
+from collections import OrderedDict
+
+from record import EDITABLE_FIELDS, REACTION_FIELDS
+from constants import SCRAPER_NAME, DEDUP_CACHE_SIZE, DEDUP_CACHE_TTL
+from metrics import DEDUP_CACHE_HITS, DEDUP_CACHE_MISSES, DEDUP_CACHE_SIZE_GAUGE
+
+
+# mutable message fields are digested by group, so a refresh rewrites only the groups which changed
+DIGEST_GROUPS = (EDITABLE_FIELDS, REACTION_FIELDS)
+
+
+class DigestCache:
+    """
+    bounded LRU cache of message_id -> digests of message mutable fields;
+    entries expire after `ttl` seconds, so every message is indexed whole at least once per ttl
+    """
+    def __init__(self, maxsize: int = DEDUP_CACHE_SIZE, ttl: int = DEDUP_CACHE_TTL) -> None:
+        self._maxsize = maxsize
+        self._ttl = ttl
+        self._digests: 'OrderedDict[str, t.Tuple[str, float]]' = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def digest(message: t.Dict[str, t.Any]) -> t.Tuple[str, ...]:
+        return tuple(
+            hashlib.blake2b(
+                json.dumps([message.get(_) for _ in fields], sort_keys=True, default=str).encode(), digest_size=16
+            ).hexdigest()
+            for fields in DIGEST_GROUPS
+        )
+
+    def changed_fields(
+        self,
+        message_id: t.Union[str, int],
+        message: t.Dict[str, t.Any]
+    ) -> t.Optional[t.Tuple[str, ...]]:
+        """
+        checks message against cached digests and remembers the new ones if message has changed
+        :return: None if message isn't cached(first seen, expired or failed to be written) and is indexed whole,
+                 otherwise mutable fields changed since it was written, empty if it's unchanged
+        """
+        if not message:  # message failed to be processed, nothing to compare
+            return None
+        message_id = str(message_id)  # ids come back from ES bulk response as strings
+        digest, now = self.digest(message), time.monotonic()
+        cached = self._digests.get(message_id)
+        if cached and cached[0] == digest and cached[1] > now:
+            self._digests.move_to_end(message_id)
+            self.hits += 1
+            DEDUP_CACHE_HITS.labels(SCRAPER_NAME).inc()
+            return tuple()
+
+        changed = None
+        if cached and cached[1] > now:
+            # ttl isn't extended by refreshes, so stored doc is still rewritten whole once per ttl
+            changed = tuple(
+                _ for fields, old, new in zip(DIGEST_GROUPS, cached[0], digest) if old != new for _ in fields
+            )
+            self._digests[message_id] = (digest, cached[1])
+        else:
+            self._digests[message_id] = (digest, now + self._ttl)
+        self._digests.move_to_end(message_id)
+        while len(self._digests) > self._maxsize:
+            self._digests.popitem(last=False)
+        self.misses += 1
+        DEDUP_CACHE_MISSES.labels(SCRAPER_NAME).inc()
+        DEDUP_CACHE_SIZE_GAUGE.labels(SCRAPER_NAME).set(len(self._digests))
+        return changed
+
+    def invalidate(self, message_ids: t.Iterable[t.Union[str, int]]) -> None:
+        """
+        forgets digests of messages which failed to be written, so they are not skipped next time
+        """
+        for message_id in message_ids:
+            self._digests.pop(str(message_id), None)
+        DEDUP_CACHE_SIZE_GAUGE.labels(SCRAPER_NAME).set(len(self._digests))
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
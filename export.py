@@ -0,0 +1,207 @@
+import os
+import sys
+import asyncio
+import argparse
+import typing as t
+
+from datetime import datetime, timezone
+from concurrent.futures import ProcessPoolExecutor
+
+import discord
+
+from logger import log
+from metrics import MESSAGES_RECEIVED
+from archive import ArchiveWriter, archive_files, read_archive
+from utils import process_message, es_client_init, es_client_close
+from sinks import ElasticsearchSink
+from ratelimit import RequestScheduler, paced
+from main import bot_client, resolve_channels
+from constants import (
+    INDEX_NAME,
+    BULK_FLUSH_SIZE,
+    SPOOL_RETRY_MAX_INTERVAL,
+    HISTORY_CONCURRENCY,
+    HISTORICAL_RUN_START_DATE,
+    BOTS
+)
+
+
+async def _archived_threads(
+    channel: t.Union[discord.TextChannel, discord.ForumChannel],
+    api_scheduler: t.Optional[RequestScheduler]
+) -> t.List[discord.Thread]:
+    threads = list()
+    kinds = ['public'] if type(channel) is discord.channel.ForumChannel else ['public', 'private']
+    for kind in kinds:
+        try:
+            # forum channels list archived posts without `private` argument
+            archived = channel.archived_threads(private=True, limit=None) if kind == 'private' \
+                else channel.archived_threads(limit=None)
+            async for thread in paced(archived, api_scheduler, f'/channels/{channel.id}/threads/archived/{kind}',
+                                      'export'):
+                threads.append(thread)
+        except discord.Forbidden as e:
+            # private archived threads require Manage Threads permission
+            log.warning(f'Forbidden to list archived threads of {channel.name}: {e}',
+                        extra={"channel_id": f"{channel.id}"})
+    return threads
+
+
+async def export_channels(
+    client: discord.client.Client,
+    channels: t.Dict[int, str],
+    archive: ArchiveWriter,
+    dt_from: datetime,
+    api_scheduler: t.Optional[RequestScheduler] = None
+) -> None:
+    """
+    streams history of channels, their active and archived threads since `dt_from` to archive files
+    """
+    semaphore = asyncio.Semaphore(HISTORY_CONCURRENCY)
+
+    async def __exporting(_channel, _channel_id) -> int:
+        counter = 0
+        received = MESSAGES_RECEIVED.labels(_channel.guild.name, _channel_id, 'export')
+        async with semaphore:
+            try:
+                history = _channel.history(limit=None, after=dt_from, oldest_first=True)
+                async for message in paced(history, api_scheduler, f'/channels/{_channel.id}/messages', 'export'):
+                    received.inc()
+                    archive.write(message)
+                    counter += 1
+            except discord.Forbidden as e:
+                log.error(f'Forbidden to access {_channel.name} message history: {e}',
+                          extra={"channel_id": f"{_channel_id}"})
+            except Exception as e:
+                log.error(f'Exception while exporting messages from {_channel.name}: {e}',
+                          extra={"channel_id": f"{_channel_id}"})
+            finally:
+                archive.close_source(_channel.id)
+        return counter
+
+    async def __exporting_channel(channel_id) -> None:
+        channel = client.get_channel(channel_id)
+        targets = list()
+        if type(channel) is not discord.channel.ForumChannel:
+            targets.append(channel)
+        targets.extend(channel.threads)
+        targets.extend(await _archived_threads(channel, api_scheduler))
+        counter = sum(await asyncio.gather(*[__exporting(_, channel_id) for _ in targets]))
+        log.info(f'Exported {counter} messages from {channel.name} and its {len(targets)} channels/threads',
+                 extra={"channel_id": f"{channel_id}"})
+
+    await asyncio.gather(*[__exporting_channel(_) for _ in channels])
+
+
+async def export(path: str, dt_from: datetime) -> None:
+    """
+    exports history of channels of all configured bots, one bot after another
+    """
+    archive = ArchiveWriter(path)
+    try:
+        for bot in BOTS:
+            api_scheduler = RequestScheduler(bot['name'])
+            client = bot_client(bot, api_scheduler)
+
+            @client.event
+            async def on_ready():
+                try:
+                    await export_channels(client, resolve_channels(client, bot), archive, dt_from, api_scheduler)
+                finally:
+                    await client.close()  # makes client.start() return
+
+            try:
+                await client.start(bot['token'])
+            finally:
+                await client.close()
+    finally:
+        archive.close()
+    log.info(f'Exported {archive.written} messages to {path}')
+
+
+async def _index(sink: ElasticsearchSink, actions: t.List[dict], max_retries: int) -> int:
+    """
+    indexes batch retrying docs failed with retryable errors(429, 5xx) with exponential backoff,
+    returns number of docs failed after all retries
+    """
+    backoff = 1
+    for attempt in range(max_retries + 1):
+        actions = await sink.send(actions)
+        if not actions:
+            return 0
+        if attempt < max_retries:
+            log.warning(f'{len(actions)} docs are not written to ES, retry in {backoff}s')
+            await asyncio.sleep(backoff)
+            backoff = min(backoff * 2, SPOOL_RETRY_MAX_INTERVAL)
+    return len(actions)
+
+
+async def _load(files: t.List[str], max_retries: int) -> t.Tuple[int, int]:
+    es = es_client_init()
+    sink = ElasticsearchSink(es)  # no dedup and checkpoints, every message is indexed whole
+    actions, loaded, failed = list(), 0, 0
+    try:
+        for path in files:
+            for message in read_archive(path):
+                _message_id, _message = await process_message(message)
+                if _message:
+                    actions.append({"_index": INDEX_NAME, '_op_type': 'index', "_id": _message_id, "_source": _message})
+                if len(actions) >= BULK_FLUSH_SIZE:
+                    _failed = await _index(sink, actions, max_retries)
+                    loaded, failed, actions = loaded + len(actions) - _failed, failed + _failed, list()
+            log.info(f'Reprocessed {path}')
+        if actions:
+            _failed = await _index(sink, actions, max_retries)
+            loaded, failed = loaded + len(actions) - _failed, failed + _failed
+    finally:
+        await es_client_close()
+    return loaded, failed
+
+
+def _load_files(files: t.List[str], max_retries: int) -> t.Tuple[int, int]:
+    # runs in worker process with its own event loop and ES client
+    return asyncio.run(_load(files, max_retries))
+
+
+def load(path: str, workers: int, max_retries: int) -> int:
+    """
+    re-runs process_message() on archived messages in worker processes, results are bulk indexed to ES;
+    returns number of messages failed to be indexed
+    """
+    files = archive_files(path)
+    workers = max(min(workers, len(files)), 1)
+    # files are sorted by size, so round-robin split gives workers about the same amount of messages
+    chunks = [files[i::workers] for i in range(workers)]
+    with ProcessPoolExecutor(workers) as pool:
+        results = list(pool.map(_load_files, chunks, [max_retries] * workers))
+    loaded, failed = sum(_[0] for _ in results), sum(_[1] for _ in results)
+    log.info(f'Loaded {loaded} messages from {len(files)} files of {path}')
+    if failed:
+        log.error(f'Failed to load {failed} messages, load the files once again to retry them')
+    return failed
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='export channels history to files and load it back to ES')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    export_parser = subparsers.add_parser('export', help='stream history of configured channels to archive files')
+    export_parser.add_argument('path')
+    export_parser.add_argument('--since', type=datetime.fromisoformat, default=None,
+                               help='UTC datetime, HISTORICAL_RUN_START_DATE or the whole history if not set')
+    load_parser = subparsers.add_parser('load', help='reprocess archive files and bulk index them to ES')
+    load_parser.add_argument('path')
+    load_parser.add_argument('--workers', type=int, default=os.cpu_count())
+    load_parser.add_argument('--max-retries', type=int, default=10,
+                             help='retries of docs failed with 429 or 5xx with exponential backoff')
+    args = parser.parse_args()
+
+    if args.command == 'export':
+        # Discord epoch is the lower bound of the whole history
+        dt_from = args.since or HISTORICAL_RUN_START_DATE or datetime(2015, 1, 1)
+        asyncio.run(export(args.path, dt_from.replace(tzinfo=timezone.utc)))
+    elif load(args.path, args.workers, args.max_retries):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
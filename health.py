@@ -0,0 +1,119 @@
+import re
+import time
+import asyncio
+import typing as t
+
+from elasticsearch import AsyncElasticsearch
+
+from logger import log
+from metrics import ES_DISCORD_NEW_DOCS_NUMBER, STARTUP_SECONDS
+from constants import SCRAPER_NAME, BOTS, INDEX_NAME, HEALTH_CHECK_INTERVAL, HEALTH_COUNT_REFRESH_INTERVAL
+
+
+_ES_DATE_MATH_UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 604800}
+
+
+def _interval_seconds(interval: str) -> t.Optional[int]:
+    # HEALTH_CHECK_INTERVAL is ES date math like `30m` or `1h`
+    match = re.fullmatch(r'(\d+)([smhdw])', interval.strip())
+    return int(match.group(1)) * _ES_DATE_MATH_UNITS[match.group(2)] if match else None
+
+
+class HealthState:
+    """
+    in-process ingest state read by /health_check; flask runs in another thread,
+    so only plain attribute assignments are done here, no locks are needed
+    """
+    def __init__(self) -> None:
+        self.started_at = time.time()
+        self.last_write_at: t.Optional[float] = None
+        self.first_write_at: t.Optional[float] = None
+        self.written_docs = 0
+        self.failed_writes = 0
+        self.es_count: t.Optional[int] = None
+        self.es_guild_counts: t.Dict[str, int] = dict()
+        self.es_count_refreshed_at: t.Optional[float] = None
+        self.channels_last_message_at: t.Dict[int, float] = dict()
+
+    def record_write(self, docs: int) -> None:
+        self.last_write_at = time.time()
+        self.written_docs += docs
+        if self.first_write_at is None and docs:
+            # time to first indexed message is the gap a restart leaves in the live stream
+            self.first_write_at = self.last_write_at
+            self.record_startup(SCRAPER_NAME, 'first_indexed')
+
+    def record_startup(self, label: str, stage: str) -> None:
+        STARTUP_SECONDS.labels(label, stage).set(time.time() - self.started_at)
+        log.info(f'Startup stage {stage} is reached in {time.time() - self.started_at:.1f}s', extra={"guild": label})
+
+    def record_failed_write(self) -> None:
+        self.failed_writes += 1
+
+    def record_message(self, channel_id: int) -> None:
+        self.channels_last_message_at[channel_id] = time.time()
+
+    def report(self, channels: t.Iterable[int]) -> t.Tuple[t.Dict[str, t.Any], bool]:
+        """
+        health report and whether scraper is healthy: something was written to ES within HEALTH_CHECK_INTERVAL
+        according to either own writes or the cached ES count
+        """
+        now = time.time()
+        interval = _interval_seconds(HEALTH_CHECK_INTERVAL)
+        wrote_recently = self.last_write_at is not None and interval is not None and now - self.last_write_at < interval
+        healthy = wrote_recently or bool(self.es_count)
+        if not healthy and self.es_count is None and interval is not None and now - self.started_at < interval:
+            healthy = True  # nothing to judge by yet right after the start
+        return {
+            'status': 'ok' if healthy else 'error',
+            'documents': self.es_count,
+            'guilds_documents': self.es_guild_counts,
+            'documents_refreshed_seconds_ago': _ago(now, self.es_count_refreshed_at),
+            'last_write_seconds_ago': _ago(now, self.last_write_at),
+            'first_write_after_start_seconds': None if self.first_write_at is None
+            else round(self.first_write_at - self.started_at, 1),
+            'written_docs': self.written_docs,
+            'failed_writes': self.failed_writes,
+            # seconds since the last message received from channel, None - nothing received since start
+            'channels_staleness': {str(_): _ago(now, self.channels_last_message_at.get(_)) for _ in channels},
+        }, healthy
+
+    async def refresh_count(self, es: AsyncElasticsearch) -> None:
+        """
+        refreshes number of docs of all scraped guilds written over HEALTH_CHECK_INTERVAL
+        every HEALTH_COUNT_REFRESH_INTERVAL, counts per guild come from the same request
+        """
+        guilds = sorted({guild for bot in BOTS for guild in bot['guilds']})
+        query = {
+            "size": 0,
+            "track_total_hits": True,
+            "query": {
+                "bool": {
+                    "filter": [
+                        {"terms": {"server_name.keyword": guilds}},
+                        {"range": {"timestamp": {"gte": f"now-{HEALTH_CHECK_INTERVAL}", "lte": "now"}}}
+                    ]
+                }
+            },
+            "aggs": {"guilds": {"terms": {"field": "server_name.keyword", "size": len(guilds)}}}
+        }
+        while True:
+            try:
+                response = await es.search(index=INDEX_NAME, body=query)
+                buckets = response['aggregations']['guilds']['buckets']
+                self.es_guild_counts = {_: 0 for _ in guilds}
+                self.es_guild_counts.update({_['key']: _['doc_count'] for _ in buckets})
+                self.es_count = response['hits']['total']['value']
+                self.es_count_refreshed_at = time.time()
+                for guild, count in self.es_guild_counts.items():
+                    ES_DISCORD_NEW_DOCS_NUMBER.labels(guild).set(count)
+            except Exception as e:
+                log.warning(f'Failed to refresh health check documents count: {e}')
+            await asyncio.sleep(HEALTH_COUNT_REFRESH_INTERVAL)
+
+
+def _ago(now: float, ts: t.Optional[float]) -> t.Optional[int]:
+    return None if ts is None else int(now - ts)
+
+
+health = HealthState()
@@ -7,7 +7,8 @@ from datetime import datetime
 from pythonjsonlogger import jsonlogger
 
 
-GUILD = os.getenv('GUILD', "")
+# default guild field of log records, multi-guild process is labeled with SCRAPER_NAME
+GUILD = os.getenv('SCRAPER_NAME') or os.getenv('GUILD') or "scraper"
 LOG_LEVEL = int(os.getenv('LOG_LEVEL', 10))
 CUSTOM_LOG_FORMAT = os.getenv('LOG_FORMAT', "%(asctime)s %(levelname)s %(guild)s %(channel_id)s %(message)s")
 WSGI_LOG_FORMAT = os.getenv('WSGI_LOG_FORMAT', "%(message)s")
@@ -4,225 +4,670 @@ import asyncio
 import threading
 import typing as t
 
-from flask import Flask
-from elasticsearch import Elasticsearch, helpers
-from elasticsearch.helpers.errors import BulkIndexError
-from prometheus_client import Gauge, make_wsgi_app
+from datetime import datetime, timezone
+from flask import Flask, jsonify
+from elasticsearch import AsyncElasticsearch
+from prometheus_client import make_wsgi_app
 from werkzeug.middleware.dispatcher import DispatcherMiddleware
 
 from logger import log
-from utils import calculate_dt_from, process_message, es_client_init, write_to_es
+from health import health
+from metrics import (
+    MESSAGES_RECEIVED,
+    QUEUE_DEPTH,
+    QUEUE_WAIT_SECONDS,
+    PASS_SECONDS,
+    discord_http_trace
+)
+from utils import (
+    calculate_dt_from,
+    process_message,
+    process_raw_message_edit,
+    history_after,
+    invalidate_guild_metadata,
+    reaction_params,
+    es_client_init,
+    es_client_close,
+    REACTION_UPDATE_SCRIPT,
+    REACTION_CLEAR_EMOJI_SCRIPT,
+    REACTION_CLEAR_SCRIPT,
+    THREAD_TITLE_UPDATE_SCRIPT
+)
+from record import EDITABLE_FIELDS, REACTION_FIELDS
+from dedup import DigestCache
+from checkpoints import CheckpointStore, PassProgress
+from scheduler import UpdateScheduler
+from ratelimit import RequestScheduler, paced
+from spool import Spool
+from overflow import StreamOverflow
+from writer import BulkWriter
+from sinks import sinks_from_config
 from constants import (
-    GUILD,
-    HEALTH_CHECK_INTERVAL,
-    ELASTICSEARCH_HOST,
-    ELASTICSEARCH_PORT,
+    SCRAPER_NAME,
     INDEX_NAME,
     MESSAGE_BATCH_SIZE,
-    SCRAPING_UPDATES_INTERVAL,
+    HISTORY_CONCURRENCY,
+    HISTORICAL_RUN_START_DATE,
+    ARCHIVED_THREADS_BACKFILL,
+    ARCHIVED_THREADS_PAGE_SIZE,
+    UPDATES_SCHEDULER_TICK,
+    EVENT_DRIVEN_UPDATES,
     QUEUE_SIZE_MULTIPLIER,
-    CHANNELS,
-    BOT_TOKEN
+    SPOOL_DIR,
+    SPOOL_RETRY_MAX_INTERVAL,
+    STREAM_CONSUMERS,
+    BOTS
 )
 
 app = Flask(__name__)
 # Add prometheus wsgi middleware to route `/metrics` requests
 app.wsgi_app = DispatcherMiddleware(app.wsgi_app, {'/metrics': make_wsgi_app()})
-ES_DISCORD_NEW_DOCS_NUMBER = Gauge('es_discord_new_docs_number',  # metric name
-                                   'number of new messages over a HEALTH_CHECK_INTERVAL period',  # description
-                                   ['guild'])  # labels
+
+# channels of all guilds served by the process
+CONFIGURED_CHANNELS = [_ for bot in BOTS for channels in bot['guilds'].values() for _ in channels]
 
 
 @app.route('/health_check')
 def health_check():
-    query = {
-      "query": {
-        "bool": {
-          "must": [
-            {
-              "match_phrase": {
-                "server_name.keyword": f"{GUILD}"
-              }
-            },
-            {
-              "range": {
-                "timestamp": {
-                  "gte": f"now-{HEALTH_CHECK_INTERVAL}",
-                  "lte": "now"
-                }
-              }
-            }
-          ]
-        }
-      }
-    }
-    es = Elasticsearch([{'host': ELASTICSEARCH_HOST, 'port': ELASTICSEARCH_PORT}])
-
-    size = es.search(index=INDEX_NAME, body=query).get('hits').get('total').get('value')
-    ES_DISCORD_NEW_DOCS_NUMBER.labels(GUILD).set(0 if size is None else size)
-    if size in [0, None]:
-        return f'Error! {size} documents found. Restart the scraper.', 500
-    else:
-        return f'Ok, {size} documents found', 200
+    """
+    answers from in-process ingest state and cached ES count, so probes cost nothing to the cluster
+    """
+    report, healthy = health.report(CONFIGURED_CHANNELS)
+    return jsonify(report), 200 if healthy else 500
+
+
+async def _collect_messages(
+    channel: t.Union[discord.TextChannel, discord.Thread],
+    after: t.Union[datetime, discord.Object],
+    channel_id: int,
+    source: str,
+    writer: BulkWriter,
+    dedup: DigestCache,
+    checkpoint: t.Optional[int] = None,
+    api_scheduler: t.Optional[RequestScheduler] = None,
+    progress: t.Optional[PassProgress] = None
+) -> int:
+    """
+    collects messages of channel or thread after the datetime or message, returns number of collected messages
+    :param channel_id: parent channel id messages are accounted to
+    :param source: history/updates/backfill, also priority of history requests in `api_scheduler`
+    :param checkpoint: channel/thread id whose checkpoint is advanced once messages are written
+    :param progress: contiguous pass which `checkpoint` channel/thread is collected by, every seen message counts
+    """
+    counter = 0
+    received = MESSAGES_RECEIVED.labels(channel.guild.name, channel_id, source)
+    tracked = progress is not None and checkpoint is not None
+    if tracked:
+        progress.start(checkpoint, writer.dropped[checkpoint])
+    try:
+        # impossible to get number of unread messages to set as limit
+        history = channel.history(limit=None, after=after)
+        async for message in paced(history, api_scheduler, f'/channels/{channel.id}/messages', source):
+            received.inc()
+            health.record_message(channel_id)
+            _message_id, _message = await process_message(message)
+            counter += 1
+            if tracked and _message:
+                progress.see(checkpoint, _message_id, _message['timestamp'])
+            changed = dedup.changed_fields(_message_id, _message)
+            if changed is None:
+                # message failed to be processed doesn't advance checkpoint
+                await writer.add(_message_id, _message, checkpoint=checkpoint if _message else None)
+            elif changed:
+                await writer.refresh(_message_id, _message, changed)
+            if source != 'updates' and counter % MESSAGE_BATCH_SIZE == 0:
+                log.info(f'Collected {counter} {source} messages so far from {channel.name}',
+                         extra={"channel_id": f"{channel_id}"})
+        if tracked:
+            progress.finish(checkpoint)
+    except discord.Forbidden as e:
+        log.error(f'Forbidden to access {channel.name} message history: {e}',
+                  extra={"channel_id": f"{channel_id}"})
+    except Exception as e:
+        log.error(f'Exception while collecting unread messages from {channel.name}: {e}',
+                  extra={"channel_id": f"{channel_id}"})
+    return counter
 
 
 async def _collect_unread_from_channels(
     client: discord.client.Client,
-    es: Elasticsearch,
+    es: AsyncElasticsearch,
+    writer: BulkWriter,
     channels: t.Dict[int, str],
+    dedup: DigestCache,
+    checkpoints: CheckpointStore,
+    intervals: t.Optional[t.Dict[int, float]] = None,
+    api_scheduler: t.Optional[RequestScheduler] = None,
     _history: bool = False
 ) -> None:
     """
     collect actual history messages from channels
+    :param intervals: updates window in seconds per channel, SCRAPING_UPDATES_INTERVAL if not set
+    :param api_scheduler: paces history requests of the bot, updates go before history of other passes
     :param _history: affects history horizon
                     True = collects long-term history for SCRAPING_HISTORY_INTERVAL
                     False = collects short-term history(aka updates) for SCRAPING_UPDATE_INTERVAL
     """
-    async def __looping_through_messages(_channel, _dt_from) -> int:
-        _counter, _messages = 0, list()
-        # impossible to get number of unread messages to set as limit
-        async for message in _channel.history(limit=None, after=_dt_from):
-            _message_id, _message = await process_message(message)
-            _messages.append({"_index": INDEX_NAME, '_op_type': 'index', "_id": _message_id, "_source": _message})
-            _counter += 1
-            if _counter % MESSAGE_BATCH_SIZE == 0:
-                try:
-                    helpers.bulk(es, _messages)
-                except BulkIndexError:
-                    pass
-                finally:
-                    _messages = list()
-
-        try:
-            helpers.bulk(es, _messages)
-        except BulkIndexError:
-            pass
-
-        return _counter
-
-    for channel_id in channels:
+    # discord.py serializes requests of the same rate-limit bucket (history route bucket is per channel/thread)
+    # and handles the global limit itself, semaphore only bounds how many channels/threads are paginated at once
+    semaphore = asyncio.Semaphore(HISTORY_CONCURRENCY)
+    done_channels = 0
+    progress = PassProgress()
+    await checkpoints.load()
+
+    async def __looping_through_messages(_channel, _dt_from, _channel_id) -> int:
+        # history continues from the checkpoint; updates window advances checkpoint only if it's contiguous
+        # with the previous passes, otherwise the messages in between would be skipped after restart
+        if _history:
+            _after = history_after(checkpoints, _channel.id, _dt_from)
+        else:
+            # the window is stretched back to the start of the previous pass unless it's too far behind,
+            # so consecutive polls chain up despite the time passed between scheduling and collecting
+            _after, _through = _dt_from, checkpoints.collected_through(_channel.id)
+            if _through is not None and _dt_from - _through <= datetime.utcnow() - _dt_from:
+                _after = min(_dt_from, _through)
+        _checkpoint = _channel.id if _history or checkpoints.covers(_channel.id, _after) else None
+        async with semaphore:
+            return await _collect_messages(_channel, _after, _channel_id, 'history' if _history else 'updates',
+                                           writer, dedup, _checkpoint, api_scheduler, progress)
+
+    async def __collecting_from_channel(channel_id) -> None:
+        nonlocal done_channels
         counter = 0
-        dt_from = calculate_dt_from(channel_id) if _history else calculate_dt_from()
-        channel = client.get_channel(channel_id)
         try:
+            if _history:
+                dt_from = await calculate_dt_from(es, channel_id, checkpoints)
+            else:
+                dt_from = await calculate_dt_from(es, interval=(intervals or {}).get(channel_id))
+            channel = client.get_channel(channel_id)
+            targets = list()
             if type(channel) is not discord.channel.ForumChannel:
-                counter = await __looping_through_messages(channel, dt_from)
+                targets.append(channel)
             # collecting history from threads in the channel, threads can be thought of as temporary sub-channels
-            for thread in channel.threads:
-                counter += await __looping_through_messages(thread, dt_from)
-        except discord.Forbidden as e:
-            log.error(f'Forbidden to access channel message history: {e}',
-                      extra={"channel_id": f"{channel_id}"})
+            targets.extend(channel.threads)
+            counter = sum(await asyncio.gather(*[__looping_through_messages(_, dt_from, channel_id) for _ in targets]))
         except Exception as e:
             log.error(f'Exception while collecting unread messages from channel: {e}',
                       extra={"channel_id": f"{channel_id}"})
         finally:
+            done_channels += 1
             if _history:
-                log.info(f'Collected {counter} history messages from channel',
+                log.info(f'Collected {counter} history messages from channel '
+                         f'({done_channels}/{len(channels)} channels done)',
                          extra={"channel_id": f"{channel_id}"})
 
+    # all channels and their threads are collected concurrently, so pass takes about as long as the slowest channel
+    with PASS_SECONDS.labels(SCRAPER_NAME, 'history' if _history else 'updates').time():
+        await asyncio.gather(*[__collecting_from_channel(channel_id) for channel_id in channels])
+    await writer.commit(progress)
+    log.info(f'Unchanged messages skipped by dedup cache so far: {dedup.hits}, hit rate {dedup.hit_rate:.2%}')
+
 
-async def collect_history(client: discord.client.Client, channels: t.Dict[int, str]) -> None:
+async def collect_history(
+    client: discord.client.Client,
+    es: AsyncElasticsearch,
+    writer: BulkWriter,
+    channels: t.Dict[int, str],
+    dedup: DigestCache,
+    checkpoints: CheckpointStore,
+    api_scheduler: t.Optional[RequestScheduler] = None
+) -> None:
     """
     history collector, history is for last SCRAPING_HISTORY_INTERVAL; serves to collect longer history horizon;
     also comes in handy to catch message we possibly lost in streaming during restarts
     """
     log.info('Start collecting history')
-    es = es_client_init()
-    await _collect_unread_from_channels(client, es, channels, _history=True)
+    await _collect_unread_from_channels(client, es, writer, channels, dedup, checkpoints,
+                                        api_scheduler=api_scheduler, _history=True)
 
 
-async def collect_updates(client: discord.client.Client, channels: t.Dict[int, str]) -> None:
+async def backfill_archived_threads(
+    client: discord.client.Client,
+    writer: BulkWriter,
+    channels: t.Dict[int, str],
+    dedup: DigestCache,
+    checkpoints: CheckpointStore,
+    api_scheduler: t.Optional[RequestScheduler] = None
+) -> None:
+    """
+    backfills archived threads of text channels and archived posts of forum channels, which aren't in channel.threads;
+    threads are listed from the most recently archived, the listing cursor is checkpointed once messages of every page
+    are spooled or written to ES, so crawl resumes where it stopped after restart; once channel is crawled through,
+    only threads archived since the previous crawl are collected; thread messages continue from the thread checkpoint
+    """
+    log.info('Start backfilling archived threads')
+    await checkpoints.load()
+    semaphore = asyncio.Semaphore(HISTORY_CONCURRENCY)
+    # whole threads are collected unless HISTORICAL_RUN_START_DATE is set, Discord epoch is the lower bound
+    dt_from = HISTORICAL_RUN_START_DATE or datetime(2015, 1, 1)
+    horizon = dt_from.replace(tzinfo=timezone.utc)  # thread archived before it has no messages after it
+
+    async def __collecting_from_thread(_thread) -> int:
+        async with semaphore:
+            return await _collect_messages(_thread, history_after(checkpoints, _thread.id, dt_from), _thread.parent_id,
+                                           'backfill', writer, dedup, _thread.id, api_scheduler)
+
+    async def __crawling(channel, kind: str) -> None:
+        counter = 0
+        newest, before, done = checkpoints.get_cursor(channel.id, kind) or (None, None, False)
+
+        async def __paging(_before, _stop_at) -> t.AsyncIterator[t.List[discord.Thread]]:
+            page = list()
+            archived = channel.archived_threads(private=True, limit=None, before=_before) if kind == 'private' \
+                else channel.archived_threads(limit=None, before=_before)
+            async for thread in paced(archived, api_scheduler, f'/channels/{channel.id}/threads/archived/{kind}',
+                                      'backfill'):
+                if thread.archive_timestamp < horizon or (_stop_at and thread.archive_timestamp < _stop_at):
+                    break
+                page.append(thread)
+                if len(page) == ARCHIVED_THREADS_PAGE_SIZE:
+                    yield page
+                    page = list()
+            if page:
+                yield page
+
+        async def __collecting_page(_page) -> None:
+            # cursor is moved past threads only once their messages are spooled or acknowledged by ES;
+            # threads whose docs were dropped are collected again from their checkpoints with exponential backoff
+            nonlocal counter
+            pending, backoff = list(_page), 1
+            while True:
+                dropped = {_.id: writer.dropped[_.id] for _ in pending}
+                counter += sum(await asyncio.gather(*[__collecting_from_thread(_) for _ in pending]))
+                await writer.sync()
+                pending = [_ for _ in pending if writer.dropped[_.id] > dropped[_.id]]
+                if not pending:
+                    return
+                log.warning(f'Failed to write messages of {len(pending)} {kind} archived threads of {channel.name}, '
+                            f'retry in {backoff}s', extra={"channel_id": f"{channel.id}"})
+                await asyncio.sleep(backoff)
+                backoff = min(backoff * 2, SPOOL_RETRY_MAX_INTERVAL)
+
+        try:
+            if newest is not None:
+                # threads archived since the previous crawl, the newest crawled one is checked once again
+                # in case more threads were archived at the same time
+                head = None
+                async for page in __paging(None, newest):
+                    head = head or page[0].archive_timestamp
+                    await __collecting_page(page)
+                if head is not None:
+                    newest = head
+                    await checkpoints.save_cursor(channel.id, kind, newest, before, done)
+            if not done:
+                async for page in __paging(before, None):
+                    await __collecting_page(page)
+                    newest = newest or page[0].archive_timestamp
+                    before = page[-1].archive_timestamp
+                    await checkpoints.save_cursor(channel.id, kind, newest, before, False)
+                await checkpoints.save_cursor(channel.id, kind, newest, before, True)
+        except discord.Forbidden as e:
+            # private archived threads require Manage Threads permission
+            log.warning(f'Forbidden to list {kind} archived threads of {channel.name}: {e}',
+                        extra={"channel_id": f"{channel.id}"})
+        except Exception as e:
+            log.error(f'Exception while backfilling {kind} archived threads of {channel.name}: {e}',
+                      extra={"channel_id": f"{channel.id}"})
+        finally:
+            log.info(f'Backfilled {counter} messages from {kind} archived threads of {channel.name}',
+                     extra={"channel_id": f"{channel.id}"})
+
+    crawls = list()
+    for channel_id in channels:
+        channel = client.get_channel(channel_id)
+        crawls.append(__crawling(channel, 'public'))
+        if type(channel) is not discord.channel.ForumChannel:  # forum posts are always public threads
+            crawls.append(__crawling(channel, 'private'))
+    with PASS_SECONDS.labels(SCRAPER_NAME, 'backfill').time():
+        await asyncio.gather(*crawls)
+
+
+async def collect_updates(
+    client: discord.client.Client,
+    es: AsyncElasticsearch,
+    writer: BulkWriter,
+    channels: t.Dict[int, str],
+    dedup: DigestCache,
+    checkpoints: CheckpointStore,
+    scheduler: UpdateScheduler,
+    api_scheduler: t.Optional[RequestScheduler] = None
+) -> None:
     """
     collect a “history” constantly in loop; serves to collect shorter history horizon:
-    every SCRAPING_UPDATES_INTERVAL seconds it collects messages from previous
-    SCRAPING_UPDATES_INTERVAL seconds in loop), thus the same message will be replaced in
-    database with updates(useful for updating reactions list and in case the message was edited)
+    channel is re-scraped since its previous poll once scheduler finds it due, thus the same message
+    will be replaced in database with updates(useful for updating reactions list and in case the message was edited);
+    hot channels are polled up to every UPDATES_MIN_INTERVAL and dormant ones every SCRAPING_UPDATES_INTERVAL
+    within UPDATES_API_BUDGET; with EVENT_DRIVEN_UPDATES edits and reactions come from stream_updates(),
+    so this loop only fills the gaps(e.g. events missed during gateway reconnects)
     """
     log.info('Start collecting updates')
-    es = es_client_init()
+
+    def _poll_cost(channel_id: int) -> int:
+        # one history request per channel/thread plus one per every 100 expected messages(history page size)
+        channel = client.get_channel(channel_id)
+        targets = len(channel.threads) + (type(channel) is not discord.channel.ForumChannel)
+        return targets + int(scheduler.expected_messages(channel_id) // 100)
+
     while True:
-        ts_to = int(time.time())
-        await _collect_unread_from_channels(client, es, channels)
-        ts_to += SCRAPING_UPDATES_INTERVAL
-        time_to_sleep = max(ts_to - time.time(), 1)
-        await asyncio.sleep(time_to_sleep)
+        intervals = scheduler.due(_poll_cost)
+        if intervals:
+            due_channels = {_: channels[_] for _ in intervals}
+            await _collect_unread_from_channels(client, es, writer, due_channels, dedup, checkpoints, intervals,
+                                                api_scheduler)
+        await asyncio.sleep(UPDATES_SCHEDULER_TICK)
 
 
-async def stream_channels(client: discord.client.Client, q: asyncio.queues.Queue) -> None:
+async def stream_channels(
+    client: discord.client.Client,
+    channels: t.Dict[int, str],
+    scheduler: UpdateScheduler,
+    overflow: StreamOverflow
+) -> None:
     """
-    function to catch every newly occurred message in every channel;
-    channel filtering will be performed later if needed during process message;
-    on_message() event catches new messages from threads(newly created/existed) as well
+    function to catch every newly occurred message in every channel of the bot;
+    only messages of the routed channels are put to the queue shared by all bots;
+    on_message() event catches new messages from threads(newly created/existed) as well;
+    stream message rate of channels drives updates polling;
+    message is processed right away, so the queue holds compact ES docs instead of discord object graphs,
+    and unless STREAM_OVERFLOW_POLICY is block, full queue never stalls gateway event dispatch
     """
     log.info('Start stream channels')
 
     @client.event
     async def on_message(message):
-        await q.put(message)
+        # threads are accounted to their parent channel to keep metric cardinality bounded
+        channel_id = getattr(message.channel, 'parent_id', None) or message.channel.id
+        # protection against a potentially recursion in case bot(client.user),
+        # writes smth in channel, even though it doesn't - skip those messages
+        if channel_id not in channels or message.author == client.user:
+            return
+        MESSAGES_RECEIVED.labels(message.guild.name, channel_id, 'stream').inc()
+        health.record_message(channel_id)
+        scheduler.record(channel_id)
+        _message_id, _message = await process_message(message)
+        await overflow.put((time.monotonic(), _message_id, _message), channel_id, scheduler)
 
 
-async def consumer(
+async def track_guild_metadata(client: discord.client.Client) -> None:
+    """
+    function to invalidate memoized category names and member roles used by process_message()
+    """
+    log.info('Start tracking guild metadata')
+
+    @client.event
+    async def on_guild_update(before, after):
+        invalidate_guild_metadata()
+
+    @client.event
+    async def on_guild_channel_update(before, after):
+        if isinstance(after, discord.CategoryChannel):
+            invalidate_guild_metadata(category_id=after.id)
+
+    @client.event
+    async def on_guild_channel_delete(channel):
+        if isinstance(channel, discord.CategoryChannel):
+            invalidate_guild_metadata(category_id=channel.id)
+
+    @client.event
+    async def on_guild_role_update(before, after):
+        invalidate_guild_metadata()  # role names are memoized per member, so all of them are affected
+
+    @client.event
+    async def on_guild_role_delete(role):
+        invalidate_guild_metadata()
+
+    @client.event
+    async def on_member_update(before, after):
+        if before.roles != after.roles:
+            invalidate_guild_metadata(member=(after.guild.id, after.id))
+
+
+async def stream_updates(
     client: discord.client.Client,
+    es: AsyncElasticsearch,
+    writer: BulkWriter,
+    channels: t.Dict[int, str]
+) -> None:
+    """
+    function to catch edits, deletions, reactions and thread changes from gateway events
+    and turn them into partial updates of already stored messages instead of re-scraping them
+    """
+    log.info('Start stream updates')
+
+    def _is_tracked(channel_id: int) -> bool:
+        # events from threads come with thread id, so the parent channel is checked as well
+        channel = client.get_channel(channel_id)
+        return channel_id in channels or getattr(channel, 'parent_id', None) in channels
+
+    @client.event
+    async def on_message_edit(before, after):
+        # cached messages are handled here, because full message object is required to resolve clean_content
+        if _is_tracked(after.channel.id) and after.author != client.user:
+            _message_id, _message = await process_message(after)
+            await writer.update(_message_id, doc={_: _message[_] for _ in EDITABLE_FIELDS if _ in _message})
+
+    @client.event
+    async def on_raw_message_edit(payload):
+        if payload.cached_message is not None or not _is_tracked(payload.channel_id):
+            return  # cached message edit is handled by on_message_edit()
+        doc = process_raw_message_edit(payload.data)
+        if doc:
+            await writer.update(payload.message_id, doc=doc)
+
+    @client.event
+    async def on_raw_message_delete(payload):
+        if _is_tracked(payload.channel_id):
+            await writer.update(payload.message_id, doc={'is_deleted': True})
+
+    @client.event
+    async def on_raw_bulk_message_delete(payload):
+        if _is_tracked(payload.channel_id):
+            for message_id in payload.message_ids:
+                await writer.update(message_id, doc={'is_deleted': True})
+
+    async def _update_reaction(payload, delta: int) -> None:
+        params = reaction_params(payload.emoji)
+        if params and _is_tracked(payload.channel_id):
+            await writer.update(payload.message_id, script=REACTION_UPDATE_SCRIPT, params={**params, 'delta': delta},
+                                fields=REACTION_FIELDS)
+
+    @client.event
+    async def on_raw_reaction_add(payload):
+        await _update_reaction(payload, 1)
+
+    @client.event
+    async def on_raw_reaction_remove(payload):
+        await _update_reaction(payload, -1)
+
+    @client.event
+    async def on_raw_reaction_clear_emoji(payload):
+        params = reaction_params(payload.emoji)
+        if params and _is_tracked(payload.channel_id):
+            await writer.update(payload.message_id, script=REACTION_CLEAR_EMOJI_SCRIPT, params=params,
+                                fields=REACTION_FIELDS)
+
+    @client.event
+    async def on_raw_reaction_clear(payload):
+        if _is_tracked(payload.channel_id):
+            await writer.update(payload.message_id, script=REACTION_CLEAR_SCRIPT, fields=REACTION_FIELDS)
+
+    @client.event
+    async def on_thread_create(thread):
+        # joining makes sure gateway delivers events of the new thread(required for private threads)
+        if thread.parent_id in channels and thread.me is None:
+            try:
+                await thread.join()
+            except discord.HTTPException as e:
+                log.error(f'Failed to join new thread {thread.name}: {e}',
+                          extra={"channel_id": f"{thread.parent_id}"})
+
+    @client.event
+    async def on_thread_update(before, after):
+        if after.parent_id in channels and before.name != after.name:
+            try:
+                await es.update_by_query(
+                    index=INDEX_NAME,
+                    body={
+                        "query": {"term": {"thread_id": after.id}},
+                        "script": {"source": THREAD_TITLE_UPDATE_SCRIPT, "params": {"thread_title": after.name}}
+                    },
+                    conflicts='proceed',
+                    wait_for_completion=False
+                )
+            except Exception as e:
+                log.error(f'Failed to update title of thread {after.id}: {e}',
+                          extra={"channel_id": f"{after.parent_id}"})
+
+
+async def consumer(
     queue: asyncio.queues.Queue,
-    es: Elasticsearch,
+    writer: BulkWriter,
+    dedup: DigestCache,
 ) -> None:
     """
-    channel filtering and message processing are performed here
+    one of STREAM_CONSUMERS workers taking processed messages of all bots streams from the queue;
+    they are micro-batched by the writer instead of being indexed one by one, while one worker waits
+    for a batch flush the others keep draining the queue
     """
     while True:
-        message = await queue.get()
-        if message is None:  # handle the case of empty queue
+        item = await queue.get()
+        if item is None:  # handle the case of empty queue
+            await writer.flush()
             break
+        enqueued_at, _message_id, _message = item
+        QUEUE_WAIT_SECONDS.labels(SCRAPER_NAME).observe(time.monotonic() - enqueued_at)
 
-        # protection against a potentially recursion in case bot(client.user),
-        # writes smth in channel, even though it doesn't - skip those messages
-        if message.author != client.user:
-            _message_id, _message = await process_message(message)
-            await write_to_es(es, _message_id, _message)
+        changed = dedup.changed_fields(_message_id, _message)
+        if changed is None:
+            await writer.add(_message_id, _message)
+        elif changed:
+            await writer.refresh(_message_id, _message, changed)
 
 
-async def main():
+def bot_client(
+    bot: t.Dict[str, t.Any],
+    api_scheduler: t.Optional[RequestScheduler] = None
+) -> discord.client.Client:
     """
-    starting and setting up the discord client, retrieving guild object and searching for channels;
-    launching history collector, streaming and queue consumer coroutines
+    discord client of one bot token, sharded if the bot is configured so
+    :param api_scheduler: learns rate limit buckets from responses of the client
     """
-    channels = dict()
-
     intents = discord.Intents.default()
     intents.message_content = True  # to get all msg content, not only from bot private msg or via explicit @bot mention
     intents.members = True
-    client = discord.Client(intents=intents)
+    # trace counts Discord API calls and rate limit waits per route
+    trace = discord_http_trace(bot['name'])
+    if api_scheduler is not None:
+        trace.on_request_end.append(api_scheduler.on_request_end)
+    if bot['sharded']:
+        # shards are spread over gateway connections of one client, shard_count=None - recommended by Discord
+        return discord.AutoShardedClient(intents=intents, http_trace=trace, shard_count=bot['shard_count'])
+    return discord.Client(intents=intents, http_trace=trace)
+
 
-    q = asyncio.Queue(maxsize=len(CHANNELS) * QUEUE_SIZE_MULTIPLIER)
-    es = es_client_init()
+def resolve_channels(client: discord.client.Client, bot: t.Dict[str, t.Any]) -> t.Dict[int, str]:
+    """
+    retrieving guild objects of the ready bot client and looking up configured channels, returns id -> name
+    """
+    channels = dict()
+    for guild_name, guild_channels in bot['guilds'].items():
+        # search for exact server in case of multiple choice
+        guild = discord.utils.get(client.guilds, name=guild_name)
+        if guild is None:
+            log.error(f'Bot {bot["name"]} is not a member of server {guild_name}', extra={"guild": guild_name})
+            continue
+        log.info(f'Listening to server: {guild.id}', extra={"guild": guild_name})
+
+        for channel_id in guild_channels:  # configured channels are looked up by id, not all guild channels scanned
+            channel = guild.get_channel(channel_id)
+            if type(channel) in [discord.channel.TextChannel, discord.channel.ForumChannel]:
+                channels[channel.id] = channel.name
+
+    configured = {_ for guild_channels in bot['guilds'].values() for _ in guild_channels}
+    log.info(f'Found {len(channels)} channels out of {len(configured)}: {channels}', extra={"guild": bot['name']})
+    log.info(f'Missing channels: {configured - set(channels.keys())}', extra={"guild": bot['name']})
+    return channels
+
+
+async def run_bot(
+    bot: t.Dict[str, t.Any],
+    overflow: StreamOverflow,
+    es: AsyncElasticsearch,
+    writer: BulkWriter,
+    dedup: DigestCache,
+    checkpoints: CheckpointStore
+) -> None:
+    """
+    starting the discord client of one bot token, searching for its channels;
+    launching history collector, updates and streaming coroutines of the bot
+    """
+    # history, updates and backfill requests of all guilds of the bot share its rate limits
+    api_scheduler = RequestScheduler(bot['name'])
+    client = bot_client(bot, api_scheduler)
 
     @client.event
     async def on_ready():
-        log.info(f'Successfully logged in as {client.user}')
+        log.info(f'Successfully logged in as {client.user}', extra={"guild": bot['name']})
+        health.record_startup(bot['name'], 'ready')
+        channels = resolve_channels(client, bot)
+        scheduler = UpdateScheduler({_: client.get_channel(_).guild.name for _ in channels})
+
+        # gateway handlers are registered before any pass starts, so live messages are indexed right away
+        # while history, updates and backfill wait for checkpoints and Discord API in background
+        await stream_channels(client, channels, scheduler, overflow)
+        await track_guild_metadata(client)
+        if EVENT_DRIVEN_UPDATES:
+            await stream_updates(client, es, writer, channels)
+        health.record_startup(bot['name'], 'stream')
+
+        coroutines = [
+            collect_history(client, es, writer, channels, dedup, checkpoints, api_scheduler),
+            collect_updates(client, es, writer, channels, dedup, checkpoints, scheduler, api_scheduler),
+        ]
+        if ARCHIVED_THREADS_BACKFILL:
+            coroutines.append(backfill_archived_threads(client, writer, channels, dedup, checkpoints, api_scheduler))
+        await asyncio.gather(*coroutines)
 
-        guild = discord.utils.get(client.guilds, name=GUILD)  # search for exact server in case of multiple choice
-        log.info(f'Listening to server: {guild.id}')
+    try:
+        await client.start(bot['token'])
+    finally:
+        await client.close()
 
-        for channel in client.get_all_channels():  # search for defined channels
-            if channel.id in CHANNELS and type(channel) in [discord.channel.TextChannel, discord.channel.ForumChannel]:
-                if channel.guild != guild:  # extra check that channel belongs to the necessary server
-                    continue
-                channels[channel.id] = channel.name
 
-        # In common case if more channels were found than it stands in input list
-        # it means that channel with same name exists in multiple different servers
-        log.info(f'Found {len(channels)} channels out of {len(CHANNELS)}: {channels}')
-        log.info(f'Missing channels: {set(CHANNELS) - set(channels.keys())}')
+async def main():
+    """
+    setting up ES client, writer and stream queue shared by all bots, launching the bots and queue consumers
+    """
+    q = asyncio.Queue(maxsize=len(CONFIGURED_CHANNELS) * QUEUE_SIZE_MULTIPLIER)
+    QUEUE_DEPTH.labels(SCRAPER_NAME).set_function(q.qsize)
+    overflow = StreamOverflow(q)
+    es = es_client_init()  # one pooled async client shared by all bots, collectors and consumer
+    dedup = DigestCache()
+    # processed docs go through durable on-disk spool, so ES outages don't drop or block them
+    checkpoints = CheckpointStore()
+    # the same processed messages go to ES and secondary sinks, so they don't need scrapers of their own
+    writer = BulkWriter(es, dedup=dedup, spool=Spool() if SPOOL_DIR else None, checkpoints=checkpoints,
+                        sinks=sinks_from_config())
+
+    async def _loading_checkpoints() -> None:
+        # all channel checkpoints are read once while bots log in, collectors wait for them only if it takes longer
+        await checkpoints.load()
+        health.record_startup(SCRAPER_NAME, 'checkpoints')
 
+    try:
         await asyncio.gather(
-            collect_history(client, channels),
-            collect_updates(client, channels),
-            stream_channels(client, q),
-            consumer(client, q, es),
+            _loading_checkpoints(),
+            writer.run(),
+            health.refresh_count(es),
+            overflow.run(),
+            *[consumer(q, writer, dedup) for _ in range(STREAM_CONSUMERS)],
+            *[run_bot(bot, overflow, es, writer, dedup, checkpoints) for bot in BOTS]
         )
-
-    await client.start(BOT_TOKEN)
+    finally:
+        await overflow.close()
+        await writer.close()
+        await es_client_close()
+        checkpoints.close()
 
 
 if __name__ == '__main__':
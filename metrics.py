@@ -0,0 +1,127 @@
+import re
+import aiohttp
+
+from prometheus_client import Counter, Gauge, Histogram
+
+
+# all metrics are labeled with guild(SCRAPER_NAME for process-wide ones, bot name for API calls)
+# and exposed on `/metrics` by prometheus wsgi middleware in main.py
+ES_DISCORD_NEW_DOCS_NUMBER = Gauge('es_discord_new_docs_number',  # metric name
+                                   'number of new messages over a HEALTH_CHECK_INTERVAL period',  # description
+                                   ['guild'])  # labels
+
+# ====================== Stream + processing ======================
+MESSAGES_RECEIVED = Counter('discord_messages_received',
+                            'number of messages received by source(stream/history/updates) per channel',
+                            ['guild', 'channel_id', 'source'])
+PROCESS_MESSAGE_SECONDS = Histogram('discord_process_message_seconds',
+                                    'time spent in process_message()',
+                                    ['guild'],
+                                    buckets=(.00005, .0001, .00025, .0005, .001, .0025, .005, .01, .05))
+QUEUE_DEPTH = Gauge('discord_queue_depth',
+                    'number of messages waiting in the stream queue',
+                    ['guild'])
+QUEUE_PUT_WAIT_SECONDS = Histogram('discord_queue_put_wait_seconds',
+                                   'time on_message() is blocked on the full stream queue',
+                                   ['guild'],
+                                   buckets=(.0001, .001, .01, .1, .5, 1, 5, 30))
+STREAM_OVERFLOW = Counter('discord_stream_overflow',
+                          'number of streamed messages which did not fit into the stream queue by overflow action',
+                          ['guild', 'action'])
+QUEUE_WAIT_SECONDS = Histogram('discord_queue_wait_seconds',
+                               'time message spent in the stream queue before it was consumed',
+                               ['guild'],
+                               buckets=(.001, .01, .05, .1, .5, 1, 5, 30))
+
+# ====================== Dedup cache ======================
+DEDUP_CACHE_HITS = Counter('discord_dedup_cache_hits',
+                           'number of unchanged messages which were not sent to ES again',
+                           ['guild'])
+DEDUP_CACHE_MISSES = Counter('discord_dedup_cache_misses',
+                             'number of new or changed messages which were sent to ES',
+                             ['guild'])
+DEDUP_CACHE_SIZE_GAUGE = Gauge('discord_dedup_cache_size',
+                               'number of message digests in dedup cache',
+                               ['guild'])
+
+# ====================== ES writes ======================
+BULK_BATCH_SIZE = Histogram('discord_bulk_batch_size',
+                            'number of actions in one ES bulk request',
+                            ['guild'],
+                            buckets=(1, 10, 50, 100, 250, 500, 1000, 2500, 5000))
+BULK_FLUSH_SECONDS = Histogram('discord_bulk_flush_seconds',
+                               'ES bulk request latency',
+                               ['guild'],
+                               buckets=(.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30))
+ES_ERRORS = Counter('discord_es_errors',
+                    'number of failed ES requests and rejected docs by error type',
+                    ['guild', 'type'])
+SINK_DOCS = Counter('discord_sink_docs',
+                    'number of docs passed to secondary sinks by outcome(sent/retried/dropped)',
+                    ['guild', 'sink', 'outcome'])
+SINK_QUEUE_DEPTH = Gauge('discord_sink_queue_depth',
+                         'number of batches waiting to be sent to secondary sink without spool',
+                         ['guild', 'sink'])
+SINK_SPOOL_BYTES = Gauge('discord_sink_spool_bytes',
+                         'size of on-disk spool of records waiting to be sent to secondary sink',
+                         ['guild', 'sink'])
+SINK_SEND_SECONDS = Histogram('discord_sink_send_seconds',
+                              'latency of sending one batch to secondary sink',
+                              ['guild', 'sink'],
+                              buckets=(.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30))
+
+# ====================== Discord API ======================
+DISCORD_API_CALLS = Counter('discord_api_calls',
+                            'number of Discord HTTP API calls by route and response status',
+                            ['guild', 'route', 'status'])
+DISCORD_RATE_LIMIT_SLEEP_SECONDS = Counter('discord_rate_limit_sleep_seconds',
+                                           'seconds of rate limit waits announced by Discord(429 or exhausted bucket)',
+                                           ['guild', 'route'])
+DISCORD_SCHEDULED_WAIT_SECONDS = Histogram('discord_scheduled_wait_seconds',
+                                           'time API request waited in request scheduler for its rate limit bucket '
+                                           'and bot budget by source(updates/history/backfill)',
+                                           ['guild', 'route', 'source'],
+                                           buckets=(.001, .01, .1, .5, 1, 5, 15, 60, 300))
+DISCORD_SCHEDULED_WAITING = Gauge('discord_scheduled_waiting',
+                                  'number of API requests waiting in request scheduler by source',
+                                  ['guild', 'source'])
+STARTUP_SECONDS = Gauge('discord_startup_seconds',
+                        'seconds from process start to startup milestone: checkpoints loaded, bot ready, '
+                        'stream listening, first doc indexed',
+                        ['guild', 'stage'])
+PASS_SECONDS = Histogram('discord_pass_seconds',
+                         'duration of history/updates passes over all channels',
+                         ['guild', 'kind'],
+                         buckets=(1, 5, 15, 30, 60, 120, 300, 600, 1800, 3600, 14400, 86400))
+UPDATES_POLL_INTERVAL_SECONDS = Gauge('discord_updates_poll_interval_seconds',
+                                      'current updates polling interval of channel chosen by its message rate',
+                                      ['guild', 'channel_id'])
+
+_SNOWFLAKE_PATTERN = re.compile(r'/\d{15,}')
+_API_VERSION_PATTERN = re.compile(r'^/api/v\d+')
+
+
+def route_of(path: str, keep_ids: bool = False) -> str:
+    # ids are cut from the path to keep label cardinality low: /channels/{id}/messages
+    path = _API_VERSION_PATTERN.sub('', path)
+    return path if keep_ids else _SNOWFLAKE_PATTERN.sub('/{id}', path)
+
+
+def discord_http_trace(label: str) -> aiohttp.TraceConfig:
+    """
+    aiohttp trace config for discord.Client(http_trace=...) counting API calls and rate limit waits of one bot
+    """
+    async def on_request_end(session, context, params):
+        route = route_of(params.url.path)
+        response = params.response
+        DISCORD_API_CALLS.labels(label, route, response.status).inc()
+        headers = response.headers
+        if response.status == 429:
+            DISCORD_RATE_LIMIT_SLEEP_SECONDS.labels(label, route).inc(float(headers.get('Retry-After', 0)))
+        elif headers.get('X-RateLimit-Remaining') == '0':
+            # discord.py sleeps till bucket reset before the next request of this route
+            DISCORD_RATE_LIMIT_SLEEP_SECONDS.labels(label, route).inc(float(headers.get('X-RateLimit-Reset-After', 0)))
+
+    trace = aiohttp.TraceConfig()
+    trace.on_request_end.append(on_request_end)
+    return trace
@@ -0,0 +1,88 @@
+import os
+import time
+import asyncio
+import typing as t
+
+from logger import log
+from metrics import STREAM_OVERFLOW, QUEUE_PUT_WAIT_SECONDS
+from scheduler import UpdateScheduler
+from spool import Spool
+from constants import SCRAPER_NAME, SPOOL_DIR, STREAM_OVERFLOW_POLICY
+
+
+# stream queue item: (enqueued_at, message_id, processed message)
+Record = t.Tuple[float, t.Union[str, int], t.Dict[str, t.Any]]
+
+# gateway delivers message a moment after it's created, coalesced poll window starts that much earlier
+COALESCE_MARGIN = 5
+
+
+class StreamOverflow:
+    """
+    puts streamed records to the stream queue, those which don't fit into the full queue are handled by policy,
+    so on_message() never waits for consumers unless policy is block:
+    spill - records are appended to on-disk spool and put back into the queue once consumers catch up,
+            spilled records left from the previous run are replayed on start
+    drop - records are dropped and counted, updates polling collects the messages later
+    coalesce - channel is made due for updates poll covering the burst, so its messages are collected
+               with a few history requests instead of being queued one by one
+    """
+    def __init__(
+        self,
+        q: asyncio.queues.Queue,
+        policy: str = STREAM_OVERFLOW_POLICY,
+        spill_dir: str = os.path.join(SPOOL_DIR, 'stream')
+    ) -> None:
+        self._q = q
+        self._policy = policy
+        self._spool = Spool(spill_dir) if policy == 'spill' else None
+        self._pending: t.List[t.Dict[str, t.Any]] = list()  # records waiting to be spilled
+        self._has_pending = asyncio.Event()
+
+    async def put(self, record: Record, channel_id: int, scheduler: UpdateScheduler) -> None:
+        if self._policy == 'block':
+            await self._q.put(record)
+            QUEUE_PUT_WAIT_SECONDS.labels(SCRAPER_NAME).observe(time.monotonic() - record[0])
+            return
+        try:
+            self._q.put_nowait(record)
+            return
+        except asyncio.QueueFull:
+            pass
+        if self._policy == 'spill' and len(self._pending) < self._q.maxsize:
+            self._pending.append({'_id': record[1], '_source': record[2]})
+            self._has_pending.set()
+            STREAM_OVERFLOW.labels(SCRAPER_NAME, 'spill').inc()
+        elif self._policy == 'coalesce':
+            scheduler.coalesce(channel_id, record[0] - COALESCE_MARGIN)
+            STREAM_OVERFLOW.labels(SCRAPER_NAME, 'coalesce').inc()
+        else:
+            # spill falls back to drop while disk writes can't keep up with the burst
+            STREAM_OVERFLOW.labels(SCRAPER_NAME, 'drop').inc()
+
+    async def _spill(self) -> None:
+        while True:
+            await self._has_pending.wait()
+            records, self._pending = self._pending, list()
+            self._has_pending.clear()
+            await self._spool.append(records)  # one fsync per accumulated batch
+
+    async def _refill(self) -> None:
+        while True:
+            path, records = await self._spool.next_segment()
+            for record in records:
+                # waiting time in the queue is counted from refill, the time spent on disk isn't
+                await self._q.put((time.monotonic(), record['_id'], record['_source']))
+            self._spool.ack(path)
+            log.info(f'Put {len(records)} spilled stream messages back to the queue')
+
+    async def run(self) -> None:
+        if self._spool is not None:
+            await asyncio.gather(self._spill(), self._refill())
+
+    async def close(self) -> None:
+        if self._spool is not None:
+            if self._pending:
+                await self._spool.append(self._pending)
+                self._pending = list()
+            await self._spool.close()
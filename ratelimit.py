@@ -0,0 +1,140 @@
+import time
+import heapq
+import asyncio
+import itertools
+import typing as t
+
+from metrics import DISCORD_SCHEDULED_WAIT_SECONDS, DISCORD_SCHEDULED_WAITING, route_of
+from constants import DISCORD_API_RATE
+
+# requests of lower value go first; live updates are never starved by history and backfill crawls
+PRIORITIES = {'updates': 0, 'history': 1, 'backfill': 2, 'export': 2}
+
+# messages and archived threads are listed by discord.py in pages of this size, one request per page
+PAGE_SIZE = 100
+
+T = t.TypeVar('T')
+
+
+class RequestScheduler:
+    """
+    paces Discord API requests of one bot ahead of its rate limits instead of running into 429s:
+    every request waits for its route bucket(tracked from X-RateLimit-* headers of the previous responses)
+    and for the bot-wide budget of `rate` requests per second; while budget is exhausted it's handed out
+    to waiting requests by priority of their source, so deep history and backfill crawls yield to updates
+    """
+    def __init__(self, label: str, rate: float = DISCORD_API_RATE) -> None:
+        self._label = label
+        self._rate = rate
+        self._tokens = rate  # burst of up to one second of requests
+        self._refilled_at = time.monotonic()
+        self._buckets: t.Dict[str, t.Tuple[int, float]] = dict()  # path -> (remaining, reset_at)
+        self._global_reset_at = 0.0
+        self._waiting: t.List[t.Tuple[int, int, str, asyncio.Future]] = list()  # heap by priority, arrival
+        self._seq = itertools.count()
+        self._wakeup: t.Optional[asyncio.Event] = None
+        self._dispatcher: t.Optional[asyncio.Future] = None
+
+    async def acquire(self, path: str, source: str) -> None:
+        """
+        waits till request to `path`(e.g. /channels/{id}/messages) of `source`(updates/history/backfill) may be sent
+        """
+        if self._dispatcher is None or self._dispatcher.done():
+            self._wakeup = asyncio.Event()
+            self._dispatcher = asyncio.ensure_future(self._dispatch())
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiting, (PRIORITIES.get(source, 1), next(self._seq), path, future))
+        self._wakeup.set()
+        started_at = time.monotonic()
+        waiting = DISCORD_SCHEDULED_WAITING.labels(self._label, source)
+        waiting.inc()
+        try:
+            await future
+        finally:
+            waiting.dec()
+        DISCORD_SCHEDULED_WAIT_SECONDS.labels(self._label, route_of(path), source).observe(time.monotonic() - started_at)
+
+    async def on_request_end(self, session, context, params) -> None:
+        """
+        aiohttp trace hook updating route bucket from response headers, added to the bot's http_trace
+        """
+        headers, now = params.response.headers, time.monotonic()
+        path = route_of(params.url.path, keep_ids=True)
+        if params.response.status == 429:
+            retry_at = now + float(headers.get('Retry-After', 1))
+            if headers.get('X-RateLimit-Global') == 'true' or headers.get('X-RateLimit-Scope') == 'global':
+                self._global_reset_at = retry_at
+            else:
+                self._buckets[path] = (0, retry_at)
+        elif 'X-RateLimit-Remaining' in headers:
+            self._buckets[path] = (int(headers['X-RateLimit-Remaining']),
+                                   now + float(headers.get('X-RateLimit-Reset-After', 0)))
+        else:
+            return
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    def _bucket_ready_at(self, path: str, now: float) -> float:
+        remaining, reset_at = self._buckets.get(path, (1, 0.0))
+        if remaining > 0 or reset_at <= now:
+            return now
+        return reset_at
+
+    async def _dispatch(self) -> None:
+        while True:
+            now = time.monotonic()
+            self._tokens = min(self._tokens + (now - self._refilled_at) * self._rate, self._rate)
+            self._refilled_at = now
+            ready_at, deferred = float('inf'), list()
+            while self._waiting:
+                entry = heapq.heappop(self._waiting)
+                path, future = entry[2], entry[3]
+                if future.done():  # waiter was cancelled
+                    continue
+                bucket_ready_at = self._bucket_ready_at(path, now)
+                if bucket_ready_at > now:
+                    # request waiting for its own bucket doesn't hold back requests to other routes
+                    ready_at = min(ready_at, bucket_ready_at)
+                    deferred.append(entry)
+                    continue
+                if self._tokens < 1 or self._global_reset_at > now:
+                    # the most important ready request waits for budget, all less important ones wait behind it
+                    deferred.append(entry)
+                    ready_at = min(ready_at, max(now + (1 - self._tokens) / self._rate, self._global_reset_at))
+                    break
+                self._tokens -= 1
+                if path in self._buckets:
+                    remaining, reset_at = self._buckets[path]
+                    self._buckets[path] = (remaining - 1, reset_at)
+                future.set_result(None)
+            for entry in deferred:
+                heapq.heappush(self._waiting, entry)
+
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), None if ready_at == float('inf') else ready_at - now)
+            except asyncio.TimeoutError:
+                pass
+
+
+async def paced(
+    items: t.AsyncIterator[T],
+    requests: t.Optional[RequestScheduler],
+    path: str,
+    source: str
+) -> t.AsyncIterator[T]:
+    """
+    passes through items of discord.py paginated iterator(channel.history(), archived_threads()),
+    the request of every next page is scheduled by `requests` first
+    """
+    items = items.__aiter__()
+    counter = 0
+    while True:
+        if requests is not None and counter % PAGE_SIZE == 0:
+            await requests.acquire(path, source)
+        try:
+            item = await items.__anext__()
+        except StopAsyncIteration:
+            return
+        counter += 1
+        yield item
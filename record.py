@@ -0,0 +1,122 @@
+import json
+import typing as t
+
+from operator import attrgetter
+from dataclasses import dataclass
+from elasticsearch.serializer import JSONSerializer
+from elasticsearch.exceptions import SerializationError
+
+try:
+    import orjson
+except ImportError:  # optional, stdlib json is used without it
+    orjson = None
+
+
+MESSAGE_FIELDS = (
+    'message_id', 'server_name', 'server_id',
+    'sender_id', 'sender_username', 'sender_display_name', 'sender_is_bot', 'sender_roles',
+    'channel_id', 'channel_title', 'channel_category', 'channel_category_id',
+    'thread_id', 'thread_title', 'thread_category', 'thread_category_id',
+    'text', 'raw_text', 'emoji_list', 'emoji_img_list', 'cashtag_list',
+    'timestamp', 'edited_at', 'computed_at',
+    'is_reply', 'reply_to_msg', 'mentions', 'reactions_dict', 'reactions_img_dict', 'media',
+)
+# mutable fields of the stored doc by what changes them, all the rest can't change after message is posted
+EDITABLE_FIELDS = ('text', 'raw_text', 'emoji_list', 'emoji_img_list', 'cashtag_list', 'mentions', 'media', 'edited_at')
+REACTION_FIELDS = ('reactions_dict', 'reactions_img_dict')
+_MESSAGE_FIELDS_SET = frozenset(MESSAGE_FIELDS)
+_message_values = attrgetter(*MESSAGE_FIELDS)
+
+
+@dataclass(eq=False)
+class MessageRecord:
+    """
+    ES doc of processed message: slots instead of a dict per in-flight message, timestamps are pre-formatted
+    ES dates, so serializing needs no datetime fallback; read-only mapping access is kept for dedup,
+    gateway events and checkpoints
+    """
+    __slots__ = MESSAGE_FIELDS
+
+    message_id: int
+    server_name: str
+    server_id: int
+    sender_id: int
+    sender_username: str
+    sender_display_name: str
+    sender_is_bot: bool
+    sender_roles: t.List[str]
+    channel_id: int
+    channel_title: str
+    channel_category: t.Optional[str]
+    channel_category_id: t.Optional[int]
+    thread_id: t.Optional[int]
+    thread_title: t.Optional[str]
+    thread_category: t.Optional[str]
+    thread_category_id: t.Optional[int]
+    text: str
+    raw_text: str
+    emoji_list: t.List[str]
+    emoji_img_list: t.List[str]
+    cashtag_list: t.List[str]
+    timestamp: str
+    edited_at: t.Optional[str]
+    computed_at: str
+    is_reply: bool
+    reply_to_msg: t.Optional[int]
+    mentions: t.List[int]
+    reactions_dict: t.Dict[str, int]
+    reactions_img_dict: t.Dict[str, int]
+    media: t.List[str]
+
+    def __getitem__(self, field: str) -> t.Any:
+        if field not in _MESSAGE_FIELDS_SET:
+            raise KeyError(field)
+        return getattr(self, field)
+
+    def __contains__(self, field: str) -> bool:
+        return field in _MESSAGE_FIELDS_SET
+
+    def get(self, field: str, default: t.Any = None) -> t.Any:
+        return getattr(self, field) if field in _MESSAGE_FIELDS_SET else default
+
+    def as_dict(self) -> t.Dict[str, t.Any]:
+        return dict(zip(MESSAGE_FIELDS, _message_values(self)))
+
+
+class FastJSONSerializer(JSONSerializer):
+    """
+    ES transport serializer backed by orjson if it's installed, which also serializes MessageRecord
+    without copying it to dict; `dumps_bytes` is used for bulk bodies to skip str round trip
+    """
+    def __init__(self) -> None:
+        # json.dumps() with custom arguments would build a new encoder on every call
+        self._encoder = json.JSONEncoder(default=self.default, ensure_ascii=False, separators=(",", ":"))
+
+    def default(self, data: t.Any) -> t.Any:
+        if isinstance(data, MessageRecord):
+            return data.as_dict()
+        return super().default(data)
+
+    def dumps_bytes(self, data: t.Any) -> bytes:
+        try:
+            if orjson is not None:
+                return orjson.dumps(data, default=self.default, option=orjson.OPT_NON_STR_KEYS)
+            if isinstance(data, MessageRecord):
+                data = data.as_dict()
+            return self._encoder.encode(data).encode()
+        except (ValueError, TypeError) as e:
+            raise SerializationError(data, e)
+
+    def dumps(self, data: t.Any) -> str:
+        # don't serialize strings
+        if isinstance(data, (str, bytes)):
+            return data
+        return self.dumps_bytes(data).decode()
+
+    def loads(self, s: t.Union[str, bytes]) -> t.Any:
+        if orjson is None:
+            return super().loads(s)
+        try:
+            return orjson.loads(s)
+        except orjson.JSONDecodeError as e:
+            raise SerializationError(s, e)
@@ -0,0 +1,106 @@
+import math
+import time
+import typing as t
+
+from metrics import UPDATES_POLL_INTERVAL_SECONDS
+from constants import (
+    SCRAPING_UPDATES_INTERVAL,
+    UPDATES_MIN_INTERVAL,
+    UPDATES_TARGET_MESSAGES,
+    UPDATES_RATE_WINDOW,
+    UPDATES_API_BUDGET
+)
+
+
+class UpdateScheduler:
+    """
+    decides when channels are polled for updates by their stream message rate: channel is due once
+    about `target_messages` new messages are expected since its previous poll; polls are paid
+    from a token bucket refilled with `api_budget` Discord API calls per minute
+    """
+    def __init__(
+        self,
+        channels: t.Dict[int, str],
+        min_interval: float = UPDATES_MIN_INTERVAL,
+        max_interval: float = SCRAPING_UPDATES_INTERVAL,
+        target_messages: float = UPDATES_TARGET_MESSAGES,
+        rate_window: float = UPDATES_RATE_WINDOW,
+        api_budget: float = UPDATES_API_BUDGET
+    ) -> None:
+        now = time.monotonic()
+        self._min_interval = min_interval
+        self._max_interval = max_interval
+        self._target_messages = target_messages
+        self._rate_window = rate_window
+        self._budget = api_budget
+        self._tokens = float(api_budget)
+        self._tokens_refilled_at = now
+        self._guilds = channels  # guild name per channel, used as metrics label
+        # exponentially decayed message rate per channel: (messages per second, updated_at)
+        self._rates: t.Dict[int, t.Tuple[float, float]] = {_: (0.0, now) for _ in channels}
+        # history pass covers the start, so the first poll is due one interval later
+        self._polled_at: t.Dict[int, float] = {_: now for _ in self._rates}
+        # channels with streamed messages which didn't fit into the stream queue: since when
+        self._coalesced: t.Dict[int, float] = dict()
+
+    def record(self, channel_id: int) -> None:
+        """
+        accounts one streamed message of the channel
+        """
+        if channel_id in self._rates:
+            now = time.monotonic()
+            self._rates[channel_id] = (self.rate(channel_id, now) + 1 / self._rate_window, now)
+
+    def coalesce(self, channel_id: int, since: float) -> None:
+        """
+        makes channel due right away with window covering streamed messages since `since`(monotonic time),
+        so a burst which didn't fit into the stream queue is collected with a few history requests
+        """
+        if channel_id in self._rates:
+            self._coalesced.setdefault(channel_id, since)
+
+    def rate(self, channel_id: int, now: float) -> float:
+        rate, updated_at = self._rates[channel_id]
+        return rate * math.exp(-(now - updated_at) / self._rate_window)
+
+    def interval(self, channel_id: int, now: float) -> float:
+        rate = self.rate(channel_id, now)
+        interval = max(self._target_messages / rate if rate else math.inf, self._min_interval)
+        return min(interval, self._max_interval) if self._max_interval else interval
+
+    def expected_messages(self, channel_id: int) -> float:
+        """
+        number of messages expected in the channel since its previous poll
+        """
+        now = time.monotonic()
+        return self.rate(channel_id, now) * (now - self._polled_at[channel_id])
+
+    def due(self, cost: t.Callable[[int], int]) -> t.Dict[int, float]:
+        """
+        channels to poll now, the most overdue first while API budget allows, with seconds since their previous poll;
+        returned channels are considered polled
+        """
+        now = time.monotonic()
+        self._tokens = min(self._budget, self._tokens + (now - self._tokens_refilled_at) * self._budget / 60)
+        self._tokens_refilled_at = now
+
+        overdue = list()
+        for channel_id in self._rates:
+            interval = self.interval(channel_id, now)
+            UPDATES_POLL_INTERVAL_SECONDS.labels(self._guilds[channel_id], channel_id).set(interval)
+            elapsed = now - self._polled_at[channel_id]
+            if channel_id in self._coalesced:
+                overdue.append((math.inf, channel_id))
+            elif elapsed >= interval:
+                overdue.append((elapsed / interval, channel_id))
+
+        due = dict()
+        for _, channel_id in sorted(overdue, reverse=True):
+            # poll costlier than the whole budget is let through once the bucket is full
+            channel_cost = min(cost(channel_id), self._budget)
+            if channel_cost > self._tokens:
+                break  # the rest waits for the budget, meanwhile they become only more overdue
+            self._tokens -= channel_cost
+            due[channel_id] = now - min(self._polled_at[channel_id], self._coalesced.pop(channel_id, now))
+            self._polled_at[channel_id] = now
+        return due
@@ -0,0 +1,358 @@
+import os
+import time
+import asyncio
+import typing as t
+
+from abc import ABC, abstractmethod
+from datetime import datetime
+
+from elasticsearch import AsyncElasticsearch
+
+from logger import log
+from metrics import (
+    BULK_BATCH_SIZE,
+    BULK_FLUSH_SECONDS,
+    ES_ERRORS,
+    SINK_DOCS,
+    SINK_QUEUE_DEPTH,
+    SINK_SPOOL_BYTES,
+    SINK_SEND_SECONDS
+)
+from health import health
+from spool import Spool
+from record import FastJSONSerializer
+from constants import (
+    SCRAPER_NAME,
+    BULK_FLUSH_SIZE,
+    SPOOL_RETRY_MAX_INTERVAL,
+    SINKS,
+    SINK_QUEUE_SIZE,
+    SINK_MAX_RETRIES,
+    KAFKA_BOOTSTRAP_SERVERS,
+    KAFKA_TOPIC,
+    FILE_SINK_DIR
+)
+
+try:
+    from aiokafka import AIOKafkaProducer
+except ImportError:  # optional, only required by kafka sink
+    AIOKafkaProducer = None
+
+
+class Sink(ABC):
+    """
+    destination of processed messages; gets batches of records and returns the ones failed with retryable errors;
+    ES sink gets writer actions, secondary sinks get records made of them by sink_record()
+    """
+    name = 'sink'
+
+    @abstractmethod
+    async def send(self, actions: t.List[t.Dict[str, t.Any]]) -> t.List[t.Dict[str, t.Any]]:
+        ...
+
+    async def close(self) -> None:
+        pass
+
+
+class ElasticsearchSink(Sink):
+    """
+    ES bulk API sink, bulk bodies are built as bytes right from the actions;
+    ids of docs rejected by ES for good and of updates of missing docs are passed to `on_rejected`,
+    records of acknowledged actions are passed to `on_written`, script updates resolved to their resulting fields
+    """
+    name = 'elasticsearch'
+
+    def __init__(
+        self,
+        es: AsyncElasticsearch,
+        flush_size: int = BULK_FLUSH_SIZE,
+        on_rejected: t.Optional[t.Callable[[t.List[t.Union[str, int]]], None]] = None,
+        on_written: t.Optional[t.Callable[[t.List[t.Dict[str, t.Any]]], t.Awaitable[None]]] = None
+    ) -> None:
+        self._es = es
+        self._flush_size = flush_size
+        self._on_rejected = on_rejected
+        self._on_written = on_written
+        self._serializer = FastJSONSerializer()
+
+    def _body(self, actions: t.List[dict]) -> bytes:
+        # `_checkpoint` and `_fields` are writer's own marks, they aren't sent to ES
+        dumps, lines = self._serializer.dumps_bytes, list()
+        for action in actions:
+            op_type = action['_op_type']
+            lines.append(dumps({op_type: {'_index': action['_index'], '_id': action['_id']}}))
+            if op_type != 'update':
+                lines.append(dumps(action['_source']))
+            elif 'script' in action:
+                # fields changed by script are returned by ES, so secondary sinks get their resulting values
+                script = {'script': action['script']}
+                if action.get('_fields') and self._on_written is not None:
+                    script['_source'] = action['_fields']
+                lines.append(dumps(script))
+            else:
+                lines.append(dumps({'doc': action['doc']}))
+        lines.append(b'')
+        return b'\n'.join(lines)
+
+    async def send(self, actions: t.List[dict]) -> t.List[dict]:
+        """
+        sends actions to ES in requests of up to `flush_size` docs, returns actions failed with retryable errors
+        (ES unavailable, 429, 5xx); docs rejected by ES for good are logged and dropped
+        """
+        failed = list()
+        for i in range(0, len(actions), self._flush_size):
+            failed.extend(await self._bulk_request(actions[i:i + self._flush_size]))
+        return failed
+
+    async def _bulk_request(self, actions: t.List[dict]) -> t.List[dict]:
+        BULK_BATCH_SIZE.labels(SCRAPER_NAME).observe(len(actions))
+        try:
+            body = self._body(actions)
+            with BULK_FLUSH_SECONDS.labels(SCRAPER_NAME).time():
+                response = await self._es.bulk(body=body)
+        except Exception as e:
+            ES_ERRORS.labels(SCRAPER_NAME, type(e).__name__).inc()
+            health.record_failed_write()
+            log.error(f'Failed to write batch of {len(actions)} docs to ES: {e}')
+            return actions
+        errors = [_ for _ in response['items'] if not 200 <= next(iter(_.values())).get('status', 500) < 300]
+        health.record_write(len(actions) - len(errors))
+
+        retry_ids, rejected, missing = set(), list(), list()
+        for error in errors:
+            for op_type, item in error.items():
+                status = item.get('status')
+                if op_type == 'update' and status == 404:
+                    # updates of messages which were never scraped(e.g. posted before the history horizon) miss
+                    missing.append(item.get('_id'))
+                    continue
+                error_type = item['error'].get('type') if isinstance(item.get('error'), dict) else str(status)
+                ES_ERRORS.labels(SCRAPER_NAME, error_type).inc()
+                if status == 429 or (isinstance(status, int) and status >= 500):
+                    retry_ids.add(str(item.get('_id')))
+                else:
+                    rejected.append(error)
+        if rejected:
+            log.error(f'ES rejected {len(rejected)} of {len(actions)} docs: {rejected[:1]}')
+        if (rejected or missing) and self._on_rejected is not None:
+            # refreshed message can be gone from ES(e.g. index was cleaned up) as well as rejected one
+            self._on_rejected([_op['_id'] for _ in rejected for _op in _.values()] + missing)
+        if self._on_written is not None:
+            records = [
+                sink_record(action, next(iter(item.values())).get('get', dict()).get('_source'))
+                for action, item in zip(actions, response['items'])
+                if 200 <= next(iter(item.values())).get('status', 500) < 300
+            ]
+            records = [_ for _ in records if _ is not None]
+            if records:
+                await self._on_written(records)
+        return [_ for _ in actions if str(_['_id']) in retry_ids]
+
+
+def sink_record(
+    action: t.Dict[str, t.Any],
+    resolved: t.Optional[t.Dict[str, t.Any]] = None
+) -> t.Optional[t.Dict[str, t.Any]]:
+    """
+    record of written action for secondary sinks: processed message of index, changed fields of update;
+    script updates(e.g. reaction deltas) are passed on as fields resolved by ES, consumers never apply ES ops;
+    None if there's nothing to pass on
+    """
+    if action['_op_type'] != 'update':
+        return {'op': 'index', 'id': action['_id'], 'message': action['_source']}
+    fields = action['doc'] if 'doc' in action else resolved
+    return {'op': 'update', 'id': action['_id'], 'fields': fields} if fields else None
+
+
+class KafkaSink(Sink):
+    """
+    produces every record as JSON message keyed by message id to Kafka-compatible broker(Kafka, Redpanda);
+    `producer` is any object with aiokafka producer start/send/stop, AIOKafkaProducer is created if it's not set
+    """
+    name = 'kafka'
+
+    def __init__(
+        self,
+        topic: str = KAFKA_TOPIC,
+        bootstrap_servers: str = KAFKA_BOOTSTRAP_SERVERS,
+        producer: t.Optional[t.Any] = None
+    ) -> None:
+        if producer is None:
+            if AIOKafkaProducer is None:
+                raise ValueError('kafka sink requires aiokafka package. Stop script')
+            producer = AIOKafkaProducer(bootstrap_servers=bootstrap_servers, compression_type='gzip', linger_ms=50)
+        self._producer = producer
+        self._topic = topic
+        self._started = False
+        self._serializer = FastJSONSerializer()
+
+    async def send(self, actions: t.List[dict]) -> t.List[dict]:
+        if not self._started:
+            await self._producer.start()
+            self._started = True
+        # messages are queued to producer batches first, then all deliveries are awaited at once
+        deliveries = [
+            await self._producer.send(self._topic, value=self._serializer.dumps_bytes(_), key=str(_['id']).encode())
+            for _ in actions
+        ]
+        results = await asyncio.gather(*deliveries, return_exceptions=True)
+        return [action for action, result in zip(actions, results) if isinstance(result, Exception)]
+
+    async def close(self) -> None:
+        if self._started:
+            await self._producer.stop()
+
+
+class FileSink(Sink):
+    """
+    appends records as JSON lines to hourly files <directory>/<YYYY-MM-DD>/<HH>.jsonl,
+    closed hours can be shipped to object storage by a sidecar; disk writes are done in executor
+    """
+    name = 'file'
+
+    def __init__(self, directory: str = FILE_SINK_DIR) -> None:
+        self._directory = directory
+        self._serializer = FastJSONSerializer()
+
+    def _append(self, lines: t.List[bytes]) -> None:
+        now = datetime.utcnow()
+        directory = os.path.join(self._directory, now.strftime('%Y-%m-%d'))
+        os.makedirs(directory, exist_ok=True)
+        with open(os.path.join(directory, now.strftime('%H.jsonl')), 'ab') as f:
+            f.write(b'\n'.join(lines) + b'\n')
+
+    async def send(self, actions: t.List[dict]) -> t.List[dict]:
+        lines = [self._serializer.dumps_bytes(_) for _ in actions]
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, self._append, lines)
+        except OSError as e:
+            log.error(f'Failed to append {len(actions)} docs to {self._directory}: {e}')
+            return actions
+        return list()
+
+
+class SinkFeeder:
+    """
+    feeds one secondary sink concurrently with ES, so slow or failing sink only falls behind itself and never
+    stalls ES or the other sinks; with `spool_dir` records are appended to sink's own on-disk spool and sent
+    from it in order, failed ones are retried with exponential backoff until they are sent, the rest is kept across
+    restarts; records are dropped and counted only once the spool is full. Without spool records are queued in memory,
+    failed ones are retried up to `max_retries` times and batches which don't fit into the full queue are dropped
+    """
+    def __init__(
+        self,
+        sink: Sink,
+        spool_dir: t.Optional[str] = None,
+        queue_size: int = SINK_QUEUE_SIZE,
+        max_retries: int = SINK_MAX_RETRIES
+    ) -> None:
+        self.sink = sink
+        self._spool = Spool(os.path.join(spool_dir, sink.name)) if spool_dir else None
+        self._queue: t.Optional[asyncio.Queue] = None
+        self._queue_size = queue_size
+        self._max_retries = max_retries
+        self._sending: t.Optional[t.List[dict]] = None  # batch being sent, it's sent once again if run() is cancelled
+        if self._spool is not None:
+            SINK_SPOOL_BYTES.labels(SCRAPER_NAME, sink.name).set_function(lambda: self._spool.size)
+
+    @property
+    def queue(self) -> asyncio.Queue:
+        if self._queue is None:  # created in the running loop
+            self._queue = asyncio.Queue(maxsize=self._queue_size)
+            SINK_QUEUE_DEPTH.labels(SCRAPER_NAME, self.sink.name).set_function(self._queue.qsize)
+        return self._queue
+
+    async def offer(self, records: t.List[t.Dict[str, t.Any]]) -> None:
+        """
+        never waits for the sink, only for the disk write
+        """
+        if self._spool is None:
+            try:
+                self.queue.put_nowait(records)
+                return
+            except asyncio.QueueFull:
+                pass
+        elif not self._spool.full:
+            try:
+                await self._spool.append(records)
+                return
+            except OSError as e:
+                log.error(f'Failed to spool {len(records)} docs for {self.sink.name} sink: {e}')
+        SINK_DOCS.labels(SCRAPER_NAME, self.sink.name, 'dropped').inc(len(records))
+        log.warning(f'Dropped batch of {len(records)} docs, {self.sink.name} sink falls behind')
+
+    async def _attempt(self, records: t.List[dict]) -> t.List[dict]:
+        started_at = time.monotonic()
+        try:
+            failed = await self.sink.send(records)
+        except Exception as e:
+            log.error(f'Failed to send batch of {len(records)} docs to {self.sink.name} sink: {e}')
+            failed = records
+        SINK_SEND_SECONDS.labels(SCRAPER_NAME, self.sink.name).observe(time.monotonic() - started_at)
+        SINK_DOCS.labels(SCRAPER_NAME, self.sink.name, 'sent').inc(len(records) - len(failed))
+        return failed
+
+    async def _send(self, records: t.List[dict], retries: int) -> None:
+        backoff = 1
+        for attempt in range(retries + 1):
+            records = await self._attempt(records)
+            if not records:
+                return
+            if attempt < retries:
+                SINK_DOCS.labels(SCRAPER_NAME, self.sink.name, 'retried').inc(len(records))
+                await asyncio.sleep(backoff)
+                backoff = min(backoff * 2, SPOOL_RETRY_MAX_INTERVAL)
+        SINK_DOCS.labels(SCRAPER_NAME, self.sink.name, 'dropped').inc(len(records))
+        log.error(f'Dropped {len(records)} docs failed to be sent to {self.sink.name} sink')
+
+    async def _drain(self) -> None:
+        # the same as BulkWriter._drain(): not sent rest of segment is kept and retried, nothing is dropped
+        backoff = 1
+        while True:
+            path, records = await self._spool.next_segment()
+            failed = await self._attempt(records)
+            if not failed:
+                self._spool.ack(path)
+                backoff = 1
+                continue
+            await self._spool.retain(path, failed)
+            SINK_DOCS.labels(SCRAPER_NAME, self.sink.name, 'retried').inc(len(failed))
+            log.warning(f'{len(failed)} spooled docs are not sent to {self.sink.name} sink, retry in {backoff}s, '
+                        f'spool size {self._spool.size} bytes')
+            await asyncio.sleep(backoff)
+            backoff = min(backoff * 2, SPOOL_RETRY_MAX_INTERVAL)
+
+    async def run(self) -> None:
+        if self._spool is not None:
+            await self._drain()
+        while True:
+            self._sending = await self.queue.get()
+            await self._send(self._sending, self._max_retries)
+            self._sending = None
+
+    async def close(self) -> None:
+        """
+        spooled records are left for the next run; without spool what's left in the queue is sent
+        with a single attempt per batch; the sink is closed
+        """
+        if self._spool is not None:
+            await self._spool.close()
+        if self._sending is not None:
+            await self._send(self._sending, 0)
+            self._sending = None
+        while self._queue is not None and not self._queue.empty():
+            await self._send(self._queue.get_nowait(), 0)
+        await self.sink.close()
+
+
+def sinks_from_config() -> t.List[Sink]:
+    """
+    secondary sinks enabled by SINKS, ES is always the primary one
+    """
+    sinks = list()
+    for name in SINKS:
+        if name == 'kafka':
+            sinks.append(KafkaSink())
+        elif name == 'file':
+            sinks.append(FileSink())
+    return sinks
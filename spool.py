@@ -0,0 +1,147 @@
+import os
+import asyncio
+import typing as t
+
+from collections import deque
+from logger import log
+from record import FastJSONSerializer
+from constants import SPOOL_DIR, SPOOL_SEGMENT_SIZE, SPOOL_MAX_SIZE
+
+
+SEGMENT_SUFFIX = '.jsonl'
+
+
+class Spool:
+    """
+    append-only on-disk queue of ES bulk actions(or secondary sink records) split into JSONL segments;
+    every appended batch is fsync-ed, segment is deleted only after all its actions are acknowledged,
+    segments left from the previous run are replayed first
+    """
+    def __init__(
+        self,
+        directory: str = SPOOL_DIR,
+        segment_size: int = SPOOL_SEGMENT_SIZE,
+        max_size: int = SPOOL_MAX_SIZE
+    ) -> None:
+        os.makedirs(directory, exist_ok=True)
+        self._directory = directory
+        self._segment_size = segment_size
+        self._max_size = max_size
+        self._serializer = FastJSONSerializer()  # same as ES transport
+
+        seqs = sorted(int(_[:-len(SEGMENT_SUFFIX)]) for _ in os.listdir(directory) if _.endswith(SEGMENT_SUFFIX))
+        self._sealed = deque(self._path(_) for _ in seqs)
+        self._seq = seqs[-1] + 1 if seqs else 0
+        self._size = sum(os.path.getsize(_) for _ in self._sealed)
+        if self._sealed:
+            log.info(f'Found {len(self._sealed)} spool segments ({self._size} bytes) left from previous run')
+
+        self._current = None
+        self._current_size = 0
+        self._lock = asyncio.Lock()  # guards current segment, disk writes are done in executor
+        self._has_data = asyncio.Event()
+        self._has_space = asyncio.Event()
+        self._has_space.set()
+
+    def _path(self, seq: int) -> str:
+        return os.path.join(self._directory, f'{seq:012d}{SEGMENT_SUFFIX}')
+
+    @property
+    def directory(self) -> str:
+        return self._directory
+
+    @property
+    def size(self) -> int:
+        return self._size
+
+    @property
+    def full(self) -> bool:
+        return self._size >= self._max_size
+
+    async def append(self, actions: t.List[t.Dict[str, t.Any]]) -> None:
+        # backpressure: producers wait until drainer frees some space
+        while self._size >= self._max_size:
+            self._has_space.clear()
+            await self._has_space.wait()
+
+        data = b''.join(self._serializer.dumps_bytes(_) + b'\n' for _ in actions)
+        async with self._lock:
+            await asyncio.get_running_loop().run_in_executor(None, self._write, data)
+        self._size += len(data)
+        self._has_data.set()
+
+    def _write(self, data: bytes) -> None:
+        if self._current is None:
+            self._current = open(self._path(self._seq), 'ab')
+            self._seq += 1
+        self._current.write(data)
+        self._current.flush()
+        os.fsync(self._current.fileno())
+        self._current_size += len(data)
+        if self._current_size >= self._segment_size:
+            self._seal()
+
+    def _seal(self) -> None:
+        self._sealed.append(self._current.name)
+        self._current.close()
+        self._current, self._current_size = None, 0
+
+    async def next_segment(self) -> t.Tuple[str, t.List[t.Dict[str, t.Any]]]:
+        """
+        waits for the oldest not yet acknowledged segment, current segment is sealed if there's nothing else
+        """
+        while not self._sealed:
+            async with self._lock:
+                if self._current is not None:
+                    self._seal()
+                    break
+                self._has_data.clear()
+            await self._has_data.wait()
+
+        path = self._sealed[0]
+        actions = await asyncio.get_running_loop().run_in_executor(None, self._read, path)
+        return path, actions
+
+    def _read(self, path: str) -> t.List[t.Dict[str, t.Any]]:
+        actions = list()
+        with open(path, 'rb') as f:
+            for line in f:
+                try:
+                    actions.append(self._serializer.loads(line))
+                except Exception as e:
+                    # only the last line could be torn if process was killed in the middle of write
+                    log.warning(f'Skipping corrupted line in spool segment {path}: {e}')
+        return actions
+
+    def ack(self, path: str) -> None:
+        """
+        removes segment once all its actions are written to ES
+        """
+        self._size -= os.path.getsize(path)
+        os.remove(path)
+        self._sealed.popleft()
+        self._has_space.set()
+
+    async def retain(self, path: str, actions: t.List[t.Dict[str, t.Any]]) -> None:
+        """
+        replaces segment with its not yet acknowledged actions to retry them later
+        """
+        data = b''.join(self._serializer.dumps_bytes(_) + b'\n' for _ in actions)
+        size = os.path.getsize(path)
+        await asyncio.get_running_loop().run_in_executor(None, self._replace, path, data)
+        self._size += len(data) - size
+        if self._size < self._max_size:
+            self._has_space.set()
+
+    @staticmethod
+    def _replace(path: str, data: bytes) -> None:
+        with open(f'{path}.tmp', 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(f'{path}.tmp', path)
+
+    async def close(self) -> None:
+        async with self._lock:
+            if self._current is not None:
+                self._seal()
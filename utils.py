@@ -1,42 +1,92 @@
 import re
+import time
 import emoji
+import asyncio
 import discord
 import typing as t
 
-from elasticsearch import Elasticsearch
-from elasticsearch.exceptions import ConflictError
+import aiohttp
+from emoji.tokenizer import tokenize, EmojiMatch
+from elasticsearch import AsyncElasticsearch, AIOHttpConnection
+from elasticsearch._async.http_aiohttp import ESClientResponse
 from datetime import datetime, timedelta, timezone
 
 from logger import log
+from metrics import PROCESS_MESSAGE_SECONDS
+from checkpoints import CheckpointStore
+from record import MessageRecord, FastJSONSerializer
+from archive import ArchivedAuthor
 from constants import (
     ELASTICSEARCH_HOST,
     ELASTICSEARCH_PORT,
+    ES_CONNECTION_POOL_SIZE,
+    ES_KEEPALIVE_TIMEOUT,
+    ES_HTTP_COMPRESS,
     INDEX_NAME,
     HISTORICAL_RUN_START_DATE as HRSD,
     SCRAPING_UPDATES_INTERVAL,
-    SCRAPING_HISTORY_INTERVAL
+    SCRAPING_HISTORY_INTERVAL,
+    MEMBER_ROLES_CACHE_SIZE
 )
 
 
-es = Elasticsearch(hosts=f"http://{ELASTICSEARCH_HOST}:{ELASTICSEARCH_PORT}", request_timeout=30)
+_es: t.Optional[AsyncElasticsearch] = None
 
 
 # ====================== Clients + Connections ======================
-def es_client_init() -> Elasticsearch:
-    return Elasticsearch(hosts=f"http://{ELASTICSEARCH_HOST}:{ELASTICSEARCH_PORT}", request_timeout=30)
+class KeepAliveAIOHttpConnection(AIOHttpConnection):
+    """
+    aiohttp connection with configurable keep-alive of idle pooled connections
+    """
+    def __init__(self, *args, keepalive_timeout: float = ES_KEEPALIVE_TIMEOUT, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._keepalive_timeout = keepalive_timeout
+
+    async def _create_aiohttp_session(self):
+        # same session as in AIOHttpConnection, only TCPConnector gets explicit keepalive_timeout
+        if self.loop is None:
+            self.loop = asyncio.get_running_loop()
+        self.session = aiohttp.ClientSession(
+            headers=self.headers,
+            skip_auto_headers=("accept", "accept-encoding"),
+            auto_decompress=True,
+            loop=self.loop,
+            cookie_jar=aiohttp.DummyCookieJar(),
+            response_class=ESClientResponse,
+            connector=aiohttp.TCPConnector(
+                limit=self._limit,
+                use_dns_cache=True,
+                ssl=self._ssl_context,
+                keepalive_timeout=self._keepalive_timeout,
+            ),
+        )
+
+
+def es_client_init() -> AsyncElasticsearch:
+    """
+    returns process-wide async ES client, all collectors and consumer share its connection pool
+    """
+    global _es
+    if _es is None:
+        _es = AsyncElasticsearch(
+            hosts=f"http://{ELASTICSEARCH_HOST}:{ELASTICSEARCH_PORT}",
+            request_timeout=30,
+            connection_class=KeepAliveAIOHttpConnection,
+            maxsize=ES_CONNECTION_POOL_SIZE,
+            http_compress=ES_HTTP_COMPRESS,
+            serializer=FastJSONSerializer(),
+        )
+    return _es
+
+
+async def es_client_close() -> None:
+    global _es
+    if _es is not None:
+        await _es.close()
+        _es = None
 
 
 # ====================== ES requests/queries/parsers ======================
-async def write_to_es(
-    es: Elasticsearch,
-    message_id: str,
-    message: t.Dict[t.Union[str, t.Any], t.Union[list, t.Any]],
-    index_name: str = INDEX_NAME
-) -> None:
-    try:
-        es.index(index=index_name, id=message_id, body=message)
-    except Exception as e:
-        log.error(f"Failed to write tweet {message_id} from {message['sender_username']} to ES: {e}")
 
 
 def _parse_time_field(time_field: t.Union[str, int]) -> datetime:
@@ -50,14 +100,14 @@ def _parse_time_field(time_field: t.Union[str, int]) -> datetime:
             raise e
 
 
-def _get_last_msg_in_es_dt(channel_id: int) -> t.Optional[datetime]:
+async def _get_last_msg_in_es_dt(es: AsyncElasticsearch, channel_id: int) -> t.Optional[datetime]:
     query = {
                 "query": {
                     "bool": {
-                        "must": [
+                        "filter": [
                             {
-                                "match": {
-                                    "channel_id": f"{channel_id}"
+                                "term": {
+                                    "channel_id": channel_id
                                 }
                             }
                         ]
@@ -70,7 +120,7 @@ def _get_last_msg_in_es_dt(channel_id: int) -> t.Optional[datetime]:
             }
 
     try:
-        last_msg = es.search(index=INDEX_NAME, body=query)
+        last_msg = await es.search(index=INDEX_NAME, body=query)
         if last_msg:
             raw_last_dt = last_msg['hits']['hits'][0]['_source']['timestamp']
             last_dt = _parse_time_field(raw_last_dt)
@@ -94,16 +144,30 @@ def _round_dt_to_5min(dt: datetime) -> datetime:
     )
 
 
-def calculate_dt_from(channel_id: t.Optional[int] = None) -> datetime:
+async def calculate_dt_from(
+    es: AsyncElasticsearch,
+    channel_id: t.Optional[int] = None,
+    checkpoints: t.Optional[CheckpointStore] = None,
+    interval: t.Optional[float] = None
+) -> datetime:
     """
     function to calculate start date for history collecting
+    :param interval: updates window in seconds set by the scheduler, not rounded to keep frequent polls cheap
     """
+    if interval is not None:
+        return datetime.utcnow() - timedelta(seconds=interval)
     dt_to = _round_dt_to_5min(datetime.utcnow())
     dt_from = dt_to - timedelta(seconds=SCRAPING_UPDATES_INTERVAL)
     if channel_id:  # True for collecting history, False for collecting updates
-        _last_msg_in_es_dt = _get_last_msg_in_es_dt(channel_id)
-        log.info(f'Last message in ES index {INDEX_NAME} is for {_last_msg_in_es_dt}',
-                 extra={"channel_id": f"{channel_id}"})
+        resume_at = checkpoints.resume_at(channel_id) if checkpoints else None
+        if resume_at:
+            _last_msg_in_es_dt = resume_at
+            log.info(f'Channel is checkpointed through {resume_at}', extra={"channel_id": f"{channel_id}"})
+        else:
+            # channel has no checkpoint yet, e.g. it was collected before checkpoints were introduced
+            _last_msg_in_es_dt = await _get_last_msg_in_es_dt(es, channel_id)
+            log.info(f'Last message in ES index {INDEX_NAME} is for {_last_msg_in_es_dt}',
+                     extra={"channel_id": f"{channel_id}"})
         # in case of empty index or explicitly set datetime to start history collection from
         dt_from = HRSD if HRSD else dt_to - timedelta(seconds=SCRAPING_HISTORY_INTERVAL)
         if _last_msg_in_es_dt:
@@ -114,8 +178,175 @@ def calculate_dt_from(channel_id: t.Optional[int] = None) -> datetime:
     return dt_from
 
 
+def history_after(
+    checkpoints: CheckpointStore,
+    channel_id: int,
+    dt_from: datetime
+) -> t.Union[datetime, discord.Object]:
+    """
+    start point of channel/thread history if it's within the history horizon, otherwise `dt_from`:
+    right after the checkpointed message(message-id precision) or since the start of the last contiguous pass,
+    whichever is later
+    """
+    checkpoint, through = checkpoints.get(channel_id), checkpoints.collected_through(channel_id)
+    if through is not None and through >= dt_from and (checkpoint is None or through > checkpoint[1]):
+        return through
+    if checkpoint and checkpoint[1] >= dt_from:
+        return discord.Object(id=checkpoint[0])
+    return dt_from
+
+
+# ====================== Partial ES updates for gateway events ======================
+REACTION_UPDATE_SCRIPT = """
+if (ctx._source.reactions_dict == null) { ctx._source.reactions_dict = new HashMap(); }
+if (ctx._source.reactions_img_dict == null) { ctx._source.reactions_img_dict = new HashMap(); }
+int count = ctx._source.reactions_img_dict.getOrDefault(params.img, 0) + params.delta;
+if (count > 0) {
+    ctx._source.reactions_dict[params.name] = count;
+    ctx._source.reactions_img_dict[params.img] = count;
+} else {
+    ctx._source.reactions_dict.remove(params.name);
+    ctx._source.reactions_img_dict.remove(params.img);
+}
+"""
+
+REACTION_CLEAR_EMOJI_SCRIPT = """
+if (ctx._source.reactions_dict != null) { ctx._source.reactions_dict.remove(params.name); }
+if (ctx._source.reactions_img_dict != null) { ctx._source.reactions_img_dict.remove(params.img); }
+"""
+
+# partial `doc` update merges objects, so emptying reactions needs a script
+REACTION_CLEAR_SCRIPT = "ctx._source.reactions_dict = new HashMap(); ctx._source.reactions_img_dict = new HashMap();"
+
+THREAD_TITLE_UPDATE_SCRIPT = "ctx._source.thread_title = params.thread_title;"
+
+
+def process_raw_message_edit(data: t.Dict[str, t.Any]) -> t.Optional[t.Dict[str, t.Any]]:
+    """
+    builds partial doc from raw gateway MESSAGE_UPDATE payload of a message missing in client cache;
+    raw_text isn't updated, because clean_content can't be resolved without full message object
+    """
+    if 'content' not in data:  # e.g. only embeds were resolved, nothing to update
+        return None
+    content = data['content']
+    edited_at = data.get('edited_timestamp')
+    emoji_list, emoji_img_list, cashtag_list = extract_emoji_and_cashtags(content)
+    return {
+        'text': content,
+        'emoji_list': emoji_list,
+        'emoji_img_list': emoji_img_list,
+        'cashtag_list': cashtag_list,
+        'mentions': [int(_['id']) for _ in data.get('mentions', [])],
+        'media': [_['url'] for _ in data.get('attachments', [])],
+        'edited_at': discord.utils.parse_time(edited_at).replace(microsecond=0).replace(tzinfo=None) if edited_at else None,
+    }
+
+
+def reaction_params(partial_emoji: discord.PartialEmoji) -> t.Optional[t.Dict[str, str]]:
+    """
+    script params for reaction updates, custom emojis are skipped the same way as in process_message
+    """
+    if not partial_emoji.is_unicode_emoji() or partial_emoji.name not in emoji.EMOJI_DATA:
+        return None
+    return {'name': emoji.EMOJI_DATA[partial_emoji.name]['en'], 'img': partial_emoji.name}
+
+
+# ====================== Fast-path extractors ======================
+CASHTAG_PATTERN = re.compile(r'\$\b([a-zA-Z]{2,})')
+
+
+def extract_emoji_and_cashtags(text: str) -> t.Tuple[t.List[str], t.List[str], t.List[str]]:
+    """
+    single pass over text returning distinct emoji names, distinct emoji images and cashtags;
+    emojis are non-ASCII and cashtags require `$`, so most plain messages skip the expensive parts
+    """
+    emoji_names, cashtags = dict(), list()  # dict keeps distinct emojis in order of appearance
+    if not text.isascii():
+        for token in tokenize(text, keep_zwj=False):
+            if isinstance(token.value, EmojiMatch) and token.value.emoji not in emoji_names:
+                emoji_names[token.value.emoji] = token.value.data['en']
+    if '$' in text:
+        cashtags = CASHTAG_PATTERN.findall(text)
+    return list(emoji_names.values()), list(emoji_names), cashtags
+
+
+def _reactions_dicts(reactions) -> t.Tuple[t.Dict[str, int], t.Dict[str, int]]:
+    reactions_dict, reactions_img_dict = dict(), dict()
+    for reaction in reactions:
+        if isinstance(reaction.emoji, str):  # don't process super reactions objects
+            reactions_dict[emoji.EMOJI_DATA[reaction.emoji]['en']] = reaction.count
+            reactions_img_dict[reaction.emoji] = reaction.count
+    return reactions_dict, reactions_img_dict
+
+
+# ====================== Memoized guild metadata ======================
+# resolving category goes through guild channels lookup and member.roles sorts guild roles on every call,
+# so both are memoized and invalidated on guild/channel/role/member update events
+_category_names: t.Dict[int, t.Optional[str]] = dict()
+_member_roles: t.Dict[t.Tuple[int, int], t.List[str]] = dict()
+
+
+def _category_name(channel) -> t.Optional[str]:
+    category_id = channel.category_id
+    if category_id is None:
+        return None
+    if category_id not in _category_names:
+        category = channel.category
+        if category is None:  # category isn't cached yet, don't memoize the miss
+            return None
+        _category_names[category_id] = category.name
+    return _category_names[category_id]
+
+
+def _sender_roles(author) -> t.List[str]:
+    if isinstance(author, ArchivedAuthor):  # reprocessed message keeps roles author had at export time
+        return author.role_names
+    if not isinstance(author, discord.Member):
+        return []
+    key = (author.guild.id, author.id)
+    roles = _member_roles.get(key)
+    if roles is None:
+        if len(_member_roles) >= MEMBER_ROLES_CACHE_SIZE:
+            _member_roles.clear()
+        roles = _member_roles[key] = [_.name for _ in author.roles]
+    return roles
+
+
+def invalidate_guild_metadata(
+    category_id: t.Optional[int] = None,
+    member: t.Optional[t.Tuple[int, int]] = None
+) -> None:
+    """
+    drops memoized category name or member roles, everything is dropped if nothing is specified
+    """
+    if category_id is not None:
+        _category_names.pop(category_id, None)
+    elif member is not None:
+        _member_roles.pop(member, None)
+    else:
+        _category_names.clear()
+        _member_roles.clear()
+
+
 # ====================== Parse message to ES format ======================
-async def process_message(message) -> t.Tuple[str, t.Dict[t.Union[str, t.Any], t.Union[list, t.Any]]]:
+def _es_date(dt: datetime) -> str:
+    # same format as ES serializer makes of naive UTC datetime with seconds precision
+    return dt.replace(microsecond=0, tzinfo=None).isoformat()
+
+
+_computed_at: t.Tuple[int, str] = (0, '')
+
+
+def _computed_at_now() -> str:
+    # one formatted value per second is shared by all messages processed within it
+    global _computed_at
+    now = int(time.time())
+    if _computed_at[0] != now:
+        _computed_at = (now, datetime.utcfromtimestamp(now).isoformat())
+    return _computed_at[1]
+
+
+async def process_message(message) -> t.Tuple[str, t.Union[MessageRecord, t.Dict[str, t.Any]]]:
 
     _channel = message.channel
     _thread = None
@@ -125,39 +356,52 @@ async def process_message(message) -> t.Tuple[str, t.Dict[t.Union[str, t.Any], t
 
     _message = dict()
     try:
-        _message = {
-             'message_id': message.id,
-             'server_name': message.guild.name,
-             'server_id': message.guild.id,
-             'sender_id': message.author.id,
-             'sender_username': message.author.name,
-             'sender_display_name': message.author.display_name,
-             'sender_is_bot': message.author.bot,
-             'sender_roles': [_.name for _ in message.author.roles] if isinstance(message.author, discord.Member) else [],
-             'channel_id': _channel.id,
-             'channel_title': _channel.name,
-             'channel_category': _channel.category.name if _channel.category else None,
-             'channel_category_id': _channel.category_id,
-             'thread_id': _thread.id if _thread else None,
-             'thread_title': _thread.name if _thread else None,
-             'thread_category': _thread.category.name if _thread and _thread.category else None,
-             'thread_category_id': _thread.category_id if _thread else None,
-             'text': message.content,
-             'raw_text': message.clean_content if hasattr(message, "clean_content") else "",
-             'emoji_list': [emoji.EMOJI_DATA[_]['en'] for _ in emoji.distinct_emoji_list(message.content)],
-             'emoji_img_list': [_ for _ in emoji.distinct_emoji_list(message.content)],
-             'cashtag_list': re.findall(r'\${1}\b([a-zA-Z]{2,})', message.content),
-             'timestamp': message.created_at.replace(microsecond=0).replace(tzinfo=None),
-             'computed_at': datetime.utcnow().replace(microsecond=0),
-             'is_reply': True if message.type.name == 'reply' else False,
-             'reply_to_msg': message.reference.message_id if message.reference else None,
-             'mentions': message.raw_mentions,
-             'reactions_dict': {emoji.EMOJI_DATA[_.emoji]['en']: _.count for _ in message.reactions if isinstance(_.emoji, str)},  # don't process super reactions objects
-             'reactions_img_dict': {_.emoji: _.count for _ in message.reactions if isinstance(_.emoji, str)},  # don't process super reactions objects
-             'media': [a.url for a in message.attachments] if message.attachments else []
-             }
+        with PROCESS_MESSAGE_SECONDS.labels(message.guild.name).time():
+            _message = _process_message(message, _channel, _thread)
     except Exception as e:
         # this zone is dangerous, because script could stack here
         log.warning(f"Exception while process message {message.id}: {e}",
                     extra={"channel_id": f"{message.channel.id}"})
     return message.id, _message
+
+
+def _process_message(message, _channel, _thread) -> MessageRecord:
+    _author = message.author
+    _content = message.content
+    _emoji_list, _emoji_img_list, _cashtag_list = extract_emoji_and_cashtags(_content)
+    _reactions_dict, _reactions_img_dict = _reactions_dicts(message.reactions)
+    # thread category is the category of its parent channel
+    _category_id = _channel.category_id
+    _category = _category_name(_channel)
+    return MessageRecord(
+        message_id=message.id,
+        server_name=message.guild.name,
+        server_id=message.guild.id,
+        sender_id=_author.id,
+        sender_username=_author.name,
+        sender_display_name=_author.display_name,
+        sender_is_bot=_author.bot,
+        sender_roles=_sender_roles(_author),
+        channel_id=_channel.id,
+        channel_title=_channel.name,
+        channel_category=_category,
+        channel_category_id=_category_id,
+        thread_id=_thread.id if _thread else None,
+        thread_title=_thread.name if _thread else None,
+        thread_category=_category if _thread else None,
+        thread_category_id=_category_id if _thread else None,
+        text=_content,
+        raw_text=message.clean_content if hasattr(message, "clean_content") else "",
+        emoji_list=_emoji_list,
+        emoji_img_list=_emoji_img_list,
+        cashtag_list=_cashtag_list,
+        timestamp=_es_date(message.created_at),
+        edited_at=_es_date(message.edited_at) if message.edited_at else None,
+        computed_at=_computed_at_now(),
+        is_reply=message.type.name == 'reply',
+        reply_to_msg=message.reference.message_id if message.reference else None,
+        mentions=message.raw_mentions,
+        reactions_dict=_reactions_dict,
+        reactions_img_dict=_reactions_img_dict,
+        media=[a.url for a in message.attachments] if message.attachments else []
+    )
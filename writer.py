@@ -0,0 +1,241 @@
+import os
+import time
+import asyncio
+import typing as t
+
+from collections import Counter
+from elasticsearch import AsyncElasticsearch
+
+from logger import log
+from dedup import DigestCache
+from checkpoints import CheckpointStore, PassProgress
+from spool import Spool
+from sinks import Sink, ElasticsearchSink, SinkFeeder
+from record import MessageRecord, REACTION_FIELDS
+from constants import (
+    INDEX_NAME,
+    BULK_FLUSH_SIZE,
+    BULK_FLUSH_INTERVAL_MS,
+    SPOOL_RETRY_MAX_INTERVAL
+)
+
+# partial `doc` update merges objects, so removed reactions would stay in reaction maps, they are replaced by script
+FIELDS_REPLACE_SCRIPT = "for (def field : params.fields.entrySet()) { ctx._source[field.getKey()] = field.getValue(); }"
+
+
+class BulkWriter:
+    """
+    micro-batching ES sink shared by the live stream, history/updates passes and gateway events;
+    batch is flushed when it reaches `flush_size` docs or `flush_interval_ms` milliseconds
+    passed since the first doc of the batch was added, whichever comes first;
+    with `spool` batches are flushed to disk first and replayed to ES by the drainer,
+    otherwise they are sent with bulk API right away;
+    docs acknowledged by ES are passed on to secondary `sinks`, each of them is fed concurrently from its own spool
+    under spool directory(or queue without spool), ES stays the primary sink: its acknowledgements advance
+    checkpoints and its backpressure slows producers down
+    """
+    def __init__(
+        self,
+        es: AsyncElasticsearch,
+        index_name: str = INDEX_NAME,
+        flush_size: int = BULK_FLUSH_SIZE,
+        flush_interval_ms: int = BULK_FLUSH_INTERVAL_MS,
+        dedup: t.Optional[DigestCache] = None,
+        spool: t.Optional[Spool] = None,
+        checkpoints: t.Optional[CheckpointStore] = None,
+        sinks: t.Optional[t.List[Sink]] = None
+    ) -> None:
+        sink_spool_dir = os.path.join(spool.directory, 'sinks') if spool is not None else None
+        self._feeders = [SinkFeeder(_, sink_spool_dir) for _ in sinks or list()]
+        self._es_sink = ElasticsearchSink(es, flush_size, on_rejected=self._invalidate,
+                                          on_written=self._fan_out if self._feeders else None)
+        self._dedup = dedup
+        self._spool = spool
+        self._checkpoints = checkpoints
+        self._index_name = index_name
+        self._flush_size = flush_size
+        self._flush_interval = flush_interval_ms / 1000
+        self._actions = list()
+        self._batch_started_at = None
+        self._not_empty = asyncio.Event()
+        self._flush_lock = asyncio.Lock()  # only one flush in flight, gives backpressure to producers
+        # docs failed to be written to ES without spool by checkpoint channel/thread id(None for unmarked ones)
+        self.dropped: t.Counter[t.Optional[int]] = Counter()
+
+    async def add(
+        self,
+        message_id: t.Union[str, int],
+        message: t.Union[MessageRecord, t.Dict[str, t.Any]],
+        checkpoint: t.Optional[int] = None
+    ) -> None:
+        """
+        :param checkpoint: channel/thread id whose checkpoint is advanced once ES acknowledges the doc
+        """
+        action = {"_index": self._index_name, '_op_type': 'index', "_id": message_id, "_source": message}
+        if checkpoint is not None:
+            action['_checkpoint'] = checkpoint
+        await self._add_action(action)
+
+    async def refresh(
+        self,
+        message_id: t.Union[str, int],
+        message: t.Union[MessageRecord, t.Dict[str, t.Any]],
+        fields: t.Iterable[str]
+    ) -> None:
+        """
+        rewrites only changed mutable fields of already written message, so ES doesn't reindex the whole doc
+        (text analysis included) just because of a new reaction
+        """
+        doc = {_: message[_] for _ in fields}
+        doc['computed_at'] = message['computed_at']
+        if any(_ in REACTION_FIELDS for _ in fields):
+            await self.update(message_id, script=FIELDS_REPLACE_SCRIPT, params={'fields': doc}, fields=list(doc))
+        else:
+            await self.update(message_id, doc=doc)
+
+    async def update(
+        self,
+        message_id: t.Union[str, int],
+        doc: t.Optional[t.Dict[str, t.Any]] = None,
+        script: t.Optional[str] = None,
+        params: t.Optional[t.Dict[str, t.Any]] = None,
+        fields: t.Optional[t.Iterable[str]] = None
+    ) -> None:
+        """
+        partial update of already stored doc, either merging `doc` into it or running painless `script`
+        :param fields: fields changed by `script`, secondary sinks get their values resulting in ES
+        """
+        action = {"_index": self._index_name, '_op_type': 'update', "_id": message_id}
+        if script is not None:
+            action['script'] = {'source': script, 'lang': 'painless', 'params': params or dict()}
+            if fields:
+                action['_fields'] = list(fields)
+        else:
+            action['doc'] = doc
+        await self._add_action(action)
+
+    async def _add_action(self, action: t.Dict[str, t.Any]) -> None:
+        if not self._actions:
+            self._batch_started_at = time.monotonic()
+            self._not_empty.set()
+        self._actions.append(action)
+        if len(self._actions) >= self._flush_size:
+            await self.flush()
+
+    async def flush(self) -> None:
+        if not self._actions:
+            return
+        actions, self._actions = self._actions, list()
+        self._batch_started_at = None
+        self._not_empty.clear()
+        async with self._flush_lock:
+            if self._spool is not None:
+                await self._spool.append(actions)
+            else:
+                failed = await self._bulk(actions)
+                if failed:
+                    self.dropped.update(_.get('_checkpoint') for _ in failed)
+                    log.error(f'Dropped {len(failed)} docs failed to be written to ES')
+                    self._invalidate([_['_id'] for _ in failed])
+
+    async def sync(self) -> None:
+        """
+        waits till docs added so far are spooled or written to ES(or dropped, see `dropped`),
+        including the ones of a flush already in flight
+        """
+        await self.flush()
+        async with self._flush_lock:
+            pass
+
+    async def commit(self, progress: PassProgress) -> None:
+        """
+        advances checkpoints of channels/threads a pass has collected through, once their messages are written;
+        channels/threads whose docs were dropped meanwhile keep their checkpoints, so they are collected again
+        """
+        await self.sync()
+        if self._checkpoints is None:
+            return
+        await self._checkpoints.collect(progress, [
+            channel_id for channel_id, (_, dropped) in progress.started.items()
+            if channel_id in progress.done and self.dropped[channel_id] == dropped
+        ])
+
+    async def _bulk(self, actions: t.List[dict]) -> t.List[dict]:
+        """
+        writes actions to ES, returns actions failed with retryable errors; checkpoints of the rest are advanced
+        """
+        failed = await self._es_sink.send(actions)
+        if self._checkpoints is not None:
+            # rejected docs won't ever be written, so only retryable ones hold checkpoints back
+            retry_ids = {str(_['_id']) for _ in failed}
+            acknowledged = [_ for _ in actions if str(_['_id']) not in retry_ids]
+            if self._spool is None:
+                # failed docs are dropped without spool, so checkpoint stays before the first of them
+                # and they are collected again after restart
+                held = dict()
+                for action in failed:
+                    channel_id, source = action.get('_checkpoint'), action.get('_source')
+                    if channel_id is not None and source:
+                        held[channel_id] = min(held.get(channel_id, source['message_id']), source['message_id'])
+                acknowledged = [
+                    _ for _ in acknowledged
+                    if _.get('_checkpoint') not in held or not _['_source']
+                    or _['_source']['message_id'] < held[_['_checkpoint']]
+                ]
+            await self._checkpoints.advance(acknowledged)
+        return failed
+
+    async def _fan_out(self, records: t.List[t.Dict[str, t.Any]]) -> None:
+        for feeder in self._feeders:
+            await feeder.offer(records)  # never waits for the sink itself
+
+    def _invalidate(self, message_ids: t.List[t.Union[str, int]]) -> None:
+        # failed docs shouldn't be skipped as unchanged next time they are collected
+        if self._dedup is not None:
+            self._dedup.invalidate(message_ids)
+
+    async def _drain(self) -> None:
+        """
+        replays spool segments to ES in order; on failures the not acknowledged rest of segment is kept
+        and retried with exponential backoff, so ES is not hammered while it's degraded
+        """
+        backoff = 1
+        while True:
+            path, actions = await self._spool.next_segment()
+            failed = await self._bulk(actions)
+            if not failed:
+                self._spool.ack(path)
+                backoff = 1
+                continue
+            await self._spool.retain(path, failed)
+            log.warning(f'{len(failed)} spooled docs are not written to ES, retry in {backoff}s, '
+                        f'spool size {self._spool.size} bytes')
+            await asyncio.sleep(backoff)
+            backoff = min(backoff * 2, SPOOL_RETRY_MAX_INTERVAL)
+
+    async def _flush_by_latency(self) -> None:
+        while True:
+            await self._not_empty.wait()
+            started_at = self._batch_started_at
+            if started_at is None:  # batch was flushed by size meanwhile
+                await asyncio.sleep(0)
+                continue
+            await asyncio.sleep(max(started_at + self._flush_interval - time.monotonic(), 0))
+            if self._batch_started_at == started_at:
+                await self.flush()
+
+    async def run(self) -> None:
+        """
+        flushes batches by max latency(size-based flushes are done in add()) and drains spool if any
+        """
+        coroutines = [self._flush_by_latency(), *[_.run() for _ in self._feeders]]
+        if self._spool is not None:
+            coroutines.append(self._drain())
+        await asyncio.gather(*coroutines)
+
+    async def close(self) -> None:
+        await self.flush()
+        if self._spool is not None:
+            await self._spool.close()
+        for feeder in self._feeders:
+            await feeder.close()